@@ -3,7 +3,7 @@
 #
 # Script (efiver.py) to show the EFI ROM version (extracted from FirmwareUpdate.pkg).
 #
-# Version 2.7 - Copyright (c) 2017 by Dr. Pike R. Alpha (PikeRAlpha@yahoo.com)
+# Version 2.8 - Copyright (c) 2017 by Dr. Pike R. Alpha (PikeRAlpha@yahoo.com)
 #
 # Updates:
 #		   - search scap files from 0xb0 onwards.
@@ -35,6 +35,7 @@
 #		   - added support for the -m argument (selects target macOS version).
 #		   - added missing lines in getRawEFIVersion()
 #		   - workaround added for missing firmware updates (like iMacPro1,1).
+#		   - pbzx decoder for all chunks (decompressed on all cores) streams the payload into cpio (no /tmp/payload.zx).
 #
 # License:
 #		   -  BSD 3-Clause License
@@ -79,11 +80,16 @@ import urllib2
 import struct
 import shutil
 import argparse
+import ctypes
+import ctypes.util
+import multiprocessing
 #import uuid
 
 from os.path import basename
 from Foundation import NSBundle
 from subprocess import Popen, PIPE
+from collections import deque
+from multiprocessing.pool import ThreadPool
 
 IOKitBundle = NSBundle.bundleWithIdentifier_('com.apple.framework.IOKit')
 
@@ -96,7 +102,7 @@ functions = [
 
 objc.loadBundleFunctions(IOKitBundle, globals(), functions)
 
-VERSION = 2.7
+VERSION = 2.8
 EFIUPDATER = "/usr/libexec/efiupdater"
 INSTALLSEED = "installSeed.py"
 FIRMWARE_UPDATE_PATH = "/tmp/FirmwareUpdate"
@@ -104,6 +110,8 @@ PAYLOAD_PATH = "Scripts/Tools/EFIPayloads"
 TMP_IA_PATH = "/tmp/InstallAssistantAuto"
 TMP_PAYLOAD = "/tmp/payload"
 FIRMWARE_PATH = "Contents/Resources/Firmware"
+PBZX_MAGIC = "pbzx"
+XZ_MAGIC = "\xfd7zXZ\x00"
 
 GLOB_SCAP_EXTENSION = "*.scap"
 GLOB_FD_EXTENSION = "*.fd"
@@ -453,51 +461,116 @@ def shouldWarnAboutUpdate(rawVersion, biosID):
 	return False
 
 
-def convertPayloadToZX(payloadPath):
-	with open(payloadPath, 'rb') as sourceFile:
-		# Payload Binary ZX magic found?
-		if sourceFile.read(4) != 'pbzx':
-			return False
-		with open("/tmp/payload.zx", 'wb') as outFile:
-			sourceFile.seek(16, 1)
-			data64 = sourceFile.read(8)
-			blockSize = struct.unpack('>Q', data64)[0]
-			outFile.write(sourceFile.read(blockSize))
-			sourceFile.seek(8, 1)
-			data64 = sourceFile.read(8)
-			blockSize = struct.unpack('>Q', data64)[0]
-			outFile.write(sourceFile.read(blockSize))
-		# check the footer of the created file.
-		with open("/tmp/payload.zx", 'rb') as checkFile:
-			checkFile.seek(-2, 2)
-			if checkFile.read(2) == 'YZ':
-				return True
-	return False
+def getXZDecoder():
+	#
+	# The lzma module (backports.lzma or pyliblzma) when we have it, liblzma (ctypes) otherwise. Both
+	# release the GIL, so that chunks can be decompressed on all cores.
+	#
+	try:
+		import lzma
+		return lambda data, size: lzma.decompress(data)
+	except ImportError:
+		pass
+
+	liblzma = ctypes.CDLL(ctypes.util.find_library('lzma') or '/usr/lib/liblzma.dylib')
+	decode = liblzma.lzma_stream_buffer_decode
+	decode.argtypes = [ctypes.POINTER(ctypes.c_uint64), ctypes.c_uint32, ctypes.c_void_p, ctypes.c_char_p, ctypes.POINTER(ctypes.c_size_t),
+		ctypes.c_size_t, ctypes.c_void_p, ctypes.POINTER(ctypes.c_size_t), ctypes.c_size_t]
+	decode.restype = ctypes.c_int
+
+	def decompress(data, size):
+		# One xz stream, size is the most that it decompresses to.
+		output = ctypes.create_string_buffer(size)
+		memoryLimit = ctypes.c_uint64(0xFFFFFFFFFFFFFFFF)
+		inputPosition = ctypes.c_size_t(0)
+		outputPosition = ctypes.c_size_t(0)
+		result = decode(ctypes.byref(memoryLimit), 0, None, data, ctypes.byref(inputPosition), len(data), output, ctypes.byref(outputPosition), size)
+
+		if result != 0:
+			raise IOError("xz decoding failed (lzma_ret %d)" % result)
+
+		return ctypes.string_at(output, outputPosition.value)
+
+	return decompress
+
+
+def decodePBZXChunk(decompress, chunk, size):
+	# Chunks that don't compress are stored as they are.
+	if chunk.startswith(XZ_MAGIC):
+		return decompress(chunk, size)
+
+	return chunk
+
+
+def decodePBZX(payloadPath, threads=None):
+	#
+	# Yields the decompressed payload (a cpio archive) in order, one chunk at a time. The file is
+	# 'pbzx' and flags, followed by chunks (flags, length and data) for as long as the flags have
+	# bit 24 set. Chunks are independent xz streams, decompressed on all cores (at most two per
+	# thread waiting to be written, so memory use doesn't grow with the size of the payload).
+	#
+	threads = threads or multiprocessing.cpu_count()
+	decompress = getXZDecoder()
+	pool = ThreadPool(threads)
+	pending = deque()
+
+	try:
+		with open(payloadPath, 'rb') as sourceFile:
+			if sourceFile.read(4) != PBZX_MAGIC:
+				raise ValueError("%s is not a pbzx payload" % basename(payloadPath))
+
+			flags = chunkSize = struct.unpack('>Q', sourceFile.read(8))[0]
+
+			while flags & 0x01000000:
+				flags, length = struct.unpack('>QQ', sourceFile.read(16))
+				chunk = sourceFile.read(length)
+
+				if len(chunk) != length:
+					raise IOError("%s is truncated" % basename(payloadPath))
+
+				# Flags is the decompressed size of the chunk.
+				pending.append(pool.apply_async(decodePBZXChunk, (decompress, chunk, max(flags & 0xFFFFFFFF, chunkSize))))
+
+				if len(pending) >= (threads * 2):
+					yield pending.popleft().get()
+
+		while pending:
+			yield pending.popleft().get()
+	finally:
+		pool.terminate()
 
 
 def extractPayloadToDirectory():
 	payloadPath = os.path.join(TMP_IA_PATH, "Payload")
 	if not os.path.exists(payloadPath):
 		return False
-	if not convertPayloadToZX(payloadPath):
-		return False
+	with open(payloadPath, 'rb') as sourceFile:
+		# Payload Binary ZX magic found?
+		if sourceFile.read(4) != PBZX_MAGIC:
+			return False
 	if os.path.exists(TMP_PAYLOAD):
 		shutil.rmtree(TMP_PAYLOAD)
 	os.makedirs(TMP_PAYLOAD)
-	cmd = ['cd /tmp/payload && /usr/bin/cpio -iF /tmp/payload.zx --quiet']
-
+	#
+	# Decoded chunks go straight into cpio (no more /tmp/payload.zx).
+	#
 	try:
-		retcode = subprocess.call(cmd, shell=True)
-		try:
-			os.remove("/tmp/payload.zx")
-		except OSError:
-			pass
-		return True
+		proc = subprocess.Popen(['/usr/bin/cpio', '-i', '--quiet'], stdin=PIPE, cwd=TMP_PAYLOAD)
 	except OSError, error:
-		print >> sys.stderr, ("ERROR: cpio -iF /tmp/payload.zx --quiet failed with %s." % error)
+		print >> sys.stderr, ("ERROR: cpio -i --quiet failed with %s." % error)
 		sys.exit(0)
 
-	return False
+	try:
+		for data in decodePBZX(payloadPath):
+			proc.stdin.write(data)
+	except (IOError, ValueError, struct.error), error:
+		print >> sys.stderr, ("ERROR: decoding of %s failed with %s." % (payloadPath, error))
+		proc.stdin.close()
+		proc.wait()
+		return False
+
+	proc.stdin.close()
+	return proc.wait() == 0
 
 
 def copyFirmwareUpdates():
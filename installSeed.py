@@ -3,7 +3,7 @@
 #
 # Script (installSeed.py) to get the latest seed package.
 #
-# Version 5.3 - Copyright (c) 2017-2018 by Dr. Pike R. Alpha (PikeRAlpha@yahoo.com)
+# Version 7.7 - Copyright (c) 2017-2018 by Dr. Pike R. Alpha (PikeRAlpha@yahoo.com)
 #
 # Updates:
 #		   - comments added
@@ -82,6 +82,30 @@
 #		   - update key and targetPath in getPackages().
 #		   - save files in the directory with the selected key.
 #		   - skip partition selection if there is only one.
+#		   - on-disk sucatalog cache with conditional GET (ETag/Last-Modified) added.
+#		   - download the gzipped sucatalog (falls back to the plain one) and decompress it while parsing.
+#		   - streaming (expat) sucatalog reader, getProduct() now only keeps the matching macOS products.
+#		   - persistent (SQLite) product index, built once per catalog revision, with sortable versions and builds.
+#		   - option -s added (fetch all seed program catalogs concurrently and show the newest build of each).
+#		   - option -d added (added/removed/changed products since the previous catalog, based on PostDate).
+#		   - fetch all distribution files at once (thread pool) and revalidate cached copies with conditional GET.
+#		   - single pass distribution file reader (memoized) replaces the ElementTree parsing in isBetaSeed() and getBuildAndVersion().
+#		   - importable as a library; Seeding.framework, Foundation and multiprocessing are loaded on demand.
+#		   - option -j added (headless query, matching products as JSON lines) and -p to select the seed program(s).
+#		   - option -M added (local caching mirror) and -r to use it.
+#		   - resumable downloads (per file journal and HTTP Range), complete files are skipped.
+#		   - large packages are downloaded in segments (multiple connections, preallocated target file).
+#		   - chunklist verification (parallel over mmap, and while downloading), damaged files are repaired.
+#		   - size aware download scheduling (small metadata files first, then the largest payloads first).
+#		   - download threads with a keep-alive connection pool (per host limit), download results and errors.
+#		   - preallocated target files, reads into a reusable buffer (option -b), CPU time per GB shown.
+#		   - download progress (rate and ETA) refreshed in place, and telemetry (option -T) as JSON lines or for Prometheus.
+#		   - package store (tmp/.packages) shared by all product keys, hardlinked (or cloned) into tmp/<key>/.
+#		   - governor mode (option -g) with a shared bandwidth limit (optionally scheduled) and low CPU/disk priority.
+#		   - catalog Digest (SHA-1) verified while downloading (on a separate thread).
+#		   - retries with jittered backoff and failover to other mirrors (option -F), resumed at the current offset.
+#		   - number of download streams adjusted to the throughput (AIMD) within limits (option -S).
+#		   - xar reader replaces pkgutil --expand (any platform), option -x expands only the given members.
 #
 # License:
 #		   -  BSD 3-Clause License
@@ -117,33 +141,74 @@
 import os
 import sys
 import glob
+import zlib
+import re
+import json
+import errno
+import random
+import hashlib
+import struct
+import mmap
+import sqlite3
 import plistlib
 import subprocess
+import shutil
+import urllib
 import urllib2
+import urlparse
+import socket
+import httplib
 import platform
 import getopt
 import signal
-import objc
+import time
+import threading
+import Queue
+import SocketServer
+import BaseHTTPServer
 
 from os.path import basename
-from Foundation import NSLocale, NSBundle, NSClassFromString
-from multiprocessing import Pool
-from xml.etree import ElementTree
+from cStringIO import StringIO
+from xml.parsers import expat
+from xml.parsers.expat import ExpatError
 from numbers import Number
 from subprocess import Popen, PIPE
-from ctypes import CDLL, c_uint, byref
 from datetime import datetime
 
-VERSION = "5.3"
+VERSION = "7.7"
 DISKUTIL = "/usr/sbin/diskutil"
 IATOOL = "Contents/MacOS/InstallAssistant"
 STARTOSINSTALL = "Contents/Resources/startosinstall"
+SUCATALOG_URL = "https://swscan.apple.com/content/catalogs/others/"
+CACHE_DIRECTORY = os.path.expanduser("~/Library/Caches/installSeed")
+PRODUCT_INDEX = os.path.join(CACHE_DIRECTORY, "products.sqlite")
+MIRROR_DIRECTORY = os.path.join(CACHE_DIRECTORY, "mirror")
+MIRROR_HOSTS = ["apple.com"]
+DOWNLOAD_SEGMENTS = 4
+SEGMENTED_DOWNLOAD_SIZE = 33554432
+CHUNKLIST_MAGIC = 0x4C4B4E43
+METADATA_SIZE = 1048576
+DOWNLOAD_THREADS = 4
+HOST_CONNECTIONS = 8
+DOWNLOAD_BUFFER_SIZE = 1048576
+TELEMETRY_FILE = None
+RETRY_ATTEMPTS = 5
+RETRY_DELAY = 1
+RETRY_MAX_DELAY = 30
+MIRROR_URLS = []
+STREAMS_MIN = 1
+STREAMS_MAX = 8
+CONCURRENCY_INTERVAL = 5
+UNPACK_MEMBERS = []
 
-os.environ['__OS_INSTALL'] = "1"
-
-SeedingBundle = NSBundle.bundleWithPath_('/System/Library/PrivateFrameworks/Seeding.framework')
-
-functions = [
+#
+# Library use (import installSeed) does not load any framework or change the environment, that
+# happens only when enrolment, language selection, SIP checks or an installation needs it.
+#
+# import installSeed
+# products = installSeed.findProducts(installSeed.SUCATALOG_URL + installSeed.seedProgramData['DeveloperSeed'], 'install')
+#
+seedingFunctions = [
 			 ('_stringForSeedProgram_', '@I'),
 			 ('_setSeedProgramPref', '@I'),
 			 ('_setCatalogForSeedProgram', '@I'),
@@ -152,7 +217,7 @@ functions = [
 			 ('_createFeedbackAssistantSymlink','@'),
 			 ]
 
-objc.loadBundleFunctions(SeedingBundle, globals(), functions)
+SeedingBundle = None
 
 #
 # Setup seed program data.
@@ -211,11 +276,28 @@ icuData = {
 #
 tmpDirectory="tmp"
 
+#
+# The package store (in the target directory) with one copy of each package, for all product keys.
+#
+storeDirectory=".packages"
+
 #
 # Name of target installer package.
 #
 installerPackage="installer.pkg"
 
+def loadSeedingFramework():
+	global SeedingBundle
+	import objc
+	from Foundation import NSBundle, NSClassFromString
+
+	if SeedingBundle == None:
+		SeedingBundle = NSBundle.bundleWithPath_('/System/Library/PrivateFrameworks/Seeding.framework')
+		objc.loadBundleFunctions(SeedingBundle, globals(), seedingFunctions)
+
+	return NSClassFromString('SDSeedProgramManager')
+
+
 def enrollInSeedProgram(targetVolume, targetProductVersion):
 	print "\n[ 1 ] Customer Seed"
 	print "[ 2 ] Developer Seed"
@@ -231,7 +313,7 @@ def enrollInSeedProgram(targetVolume, targetProductVersion):
 		except:
 			sys.stdout.write("\033[F\033[K")
 
-	seedProgramManager = NSClassFromString('SDSeedProgramManager')
+	seedProgramManager = loadSeedingFramework()
 	seedProgram = seedProgramManager._stringForSeedProgram_(program)
 	print "Seeding: Enrolling in seed program: %s" % seedProgram
 	seedProgramManager._setSeedProgramPref_(program)
@@ -252,8 +334,9 @@ def enrollInSeedProgram(targetVolume, targetProductVersion):
 
 
 def getOSVersion():
-	version = platform.mac_ver()
-	return float('.'.join(version[0].split('.')[:2]))
+	version = platform.mac_ver()[0]
+	# 0.0 when this isn't macOS (think -j or -d on another platform).
+	return float('.'.join(version.split('.')[:2])) if version else 0.0
 
 
 def getOSNameByOSVersion(version):
@@ -282,6 +365,7 @@ def getICUName(id):
 
 def selectLanguage(macOSVersion):
 	if macOSVersion > 10.11:
+		from Foundation import NSLocale
 		locale = NSLocale.currentLocale()
 		languageCode = NSLocale.languageCode(locale)
 		id = languageCode
@@ -289,10 +373,16 @@ def selectLanguage(macOSVersion):
 		localeIdentifier = NSLocale.localeIdentifier(locale)
 	else:
 		cmd = ["defaults", 'read', '.GlobalPreferences', 'AppleLocale']
-		proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-		output, err = proc.communicate()
 
-		if proc.returncode:
+		try:
+			proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+			output, err = proc.communicate()
+			failed = proc.returncode
+		except OSError:
+			# No defaults command (not macOS).
+			failed = True
+
+		if failed:
 			id = "en"
 			localeIdentifier = "en_US"
 			languageCode = id
@@ -353,28 +443,95 @@ def getPath(targetVolume, targetPath):
 
 
 def downloadDistributionFile(url, targetPath):
-	try:
-		req = urllib2.urlopen(url)
-	except urllib2.URLError:
-		print >> sys.stderr("\nERROR: opening of (%s) failed. Aborting ...\n" % url)
-
 	filename = basename(url)
-	filesize = req.info().getheader('Content-Length')
 	distributionFile = os.path.join(targetPath, filename)
+	cacheInfo = getCacheInfo(url)
+	headers = {}
 
 	if os.path.exists(distributionFile):
-		os.remove(distributionFile)
+		#
+		# Revalidate the copy from a previous run (tmp/<key>/<filename>).
+		#
+		if 'ETag' in cacheInfo:
+			headers['If-None-Match'] = cacheInfo['ETag']
+		if 'Last-Modified' in cacheInfo:
+			headers['If-Modified-Since'] = cacheInfo['Last-Modified']
+	policy = RetryPolicy(url)
+	view = getDownloadBuffer()
 
-	with open(distributionFile, 'w') as file:
-		while True:
-			chunk = req.read(1024)
-			if not chunk:
+	while True:
+		req = None
+		try:
+			req = connectionPool.urlopen(policy.getURL(), headers)
+
+			if req.getcode() != 304:
+				with open(distributionFile + ".part", 'wb') as file:
+					while True:
+						count = readInto(req, view)
+						if not count:
+							break
+						file.write(view[:count])
+			break
+		except (urllib2.URLError, IOError, httplib.HTTPException), error:
+			if req:
+				req.close()
+
+			if not policy.failed(error):
+				req = None
 				break
-			file.write(chunk)
 
+	if req == None or req.getcode() == 304:
+		if os.path.exists(distributionFile):
+			if req == None:
+				print >> sys.stderr, ("\nWarning: opening of (%s) failed. Using cached copy ..." % url)
+			else:
+				req.close()
+			return distributionFile
+		print >> sys.stderr, ("\nERROR: opening of (%s) failed ...\n" % url)
+		return None
+
+	req.close()
+	os.rename(distributionFile + ".part", distributionFile)
+	headers = req.info()
+	cacheInfo = dict(URL=url)
+
+	for header in ('ETag', 'Last-Modified'):
+		if headers.getheader(header):
+			cacheInfo[header] = headers.getheader(header)
+
+	plistlib.writePlist(cacheInfo, getCachePath(url, ".plist"))
 	return distributionFile
 
 
+def getDistributionURL(product, languageSelector):
+	distributions = product['Distributions']
+	return distributions.get(languageSelector, distributions.get(icuData['en']))
+
+
+def getDistributionFiles(data, targetVolume, languageSelector):
+	argumentData = []
+
+	for index in range(0, len(data), 2):
+		key = data[index]
+		targetPath = os.path.join(targetVolume, tmpDirectory, key)
+
+		if not os.path.isdir(targetPath):
+			os.makedirs(targetPath)
+
+		argumentData.append([getDistributionURL(data[index+1], languageSelector), targetPath])
+
+	if len(argumentData) == 0:
+		return []
+	#
+	# The user picks only one, but all of them are needed to show the selection list. Fetch them at once.
+	#
+	from multiprocessing.pool import ThreadPool
+	p = ThreadPool(min(len(argumentData), 8))
+	distributionFiles = p.map(lambda argument: downloadDistributionFile(argument[0], argument[1]), argumentData)
+	p.close()
+	return distributionFiles
+
+
 def getSystemVersionPlist(targetVolume, target):
 	systemVersionPlist = plistlib.readPlist(getPath(targetVolume, "System/Library/CoreServices/SystemVersion.plist"))
 	
@@ -408,121 +565,2396 @@ def getSeedProgram(targetVolume):
 	return (seedProgram, targetProductVersion)
 
 
-def getCatalogData(targetVolume):
-	seedProgram, targetProductVersion = getSeedProgram(targetVolume)
+def getCachePath(url, extension):
+	if not os.path.isdir(CACHE_DIRECTORY):
+		os.makedirs(CACHE_DIRECTORY)
+	#
+	# One set of files per URL (think <sha1>.sucatalog and <sha1>.plist).
+	#
+	return os.path.join(CACHE_DIRECTORY, hashlib.sha1(url).hexdigest() + extension)
+
+
+def getCacheInfo(url):
+	try:
+		return plistlib.readPlist(getCachePath(url, ".plist"))
+	except (IOError, ExpatError):
+		return {}
+
+
+class CatalogStream(object):
+	#
+	# File-like wrapper that feeds (gzip) catalog data to the parser while the download is still
+	# arriving. The raw bytes are written to the cache as they pass, only one chunk lives in memory.
+	#
+	def __init__(self, source, isCompressed, cacheFile=None, cacheInfo=None):
+		self.source = source
+		self.cacheFile = cacheFile
+		self.cacheInfo = cacheInfo
+		self.target = None
+		self.decompressor = None
+		self.pending = ''
+
+		if isCompressed:
+			# 16 + MAX_WBITS tells zlib to expect (and skip) the gzip header.
+			self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+		if cacheFile:
+			#
+			# One .part file per transfer, the mirror (-M) fetches the same catalog for concurrent clients.
+			#
+			self.partFile = "%s.%d-%d.part" % (cacheFile, os.getpid(), threading.current_thread().ident)
+			self.target = open(self.partFile, 'wb')
+
+	def read(self, size=65536):
+		if size <= 0:
+			size = 65536
+
+		while True:
+			if self.pending:
+				data, self.pending = self.pending[:size], self.pending[size:]
+			elif self.decompressor and self.decompressor.unconsumed_tail:
+				data = self.decompressor.decompress(self.decompressor.unconsumed_tail, size)
+			else:
+				chunk = self.source.read(65536 if self.decompressor else size)
+
+				if not chunk:
+					self.finish()
+
+					if self.decompressor:
+						self.pending = self.decompressor.flush()
+						self.decompressor = None
+						continue
+					return chunk
+				if self.target:
+					self.target.write(chunk)
+				if not self.decompressor:
+					return chunk
+
+				data = self.decompressor.decompress(chunk, size)
+
+			if data:
+				return data
+
+	def finish(self):
+		if self.target:
+			#
+			# Complete transfer, replace the cached copy and save the validators (ETag/Last-Modified).
+			#
+			self.target.close()
+			self.target = None
+			os.rename(self.partFile, self.cacheFile)
+			plistlib.writePlist(self.cacheInfo, self.partFile)
+			os.rename(self.partFile, getCachePath(self.cacheInfo['CatalogURL'], ".plist"))
+
+	def close(self):
+		if self.target:
+			# Incomplete transfer.
+			self.target.close()
+			self.target = None
+			os.remove(self.partFile)
+		self.source.close()
+
+
+def openCatalogCache(cacheFile, cacheInfo):
+	return CatalogStream(open(cacheFile, 'rb'), cacheInfo.get('Compressed', False), cacheInfo=cacheInfo)
+
+
+def fetchCatalog(catalogURL):
+	cacheFile = getCachePath(catalogURL, ".sucatalog")
+	cacheInfo = getCacheInfo(catalogURL)
+	policy = RetryPolicy(catalogURL)
+
+	while True:
+		catalogReq = None
+		#
+		# Ask for the gzip variant first (about a tenth of the size), fall back to the plain catalog.
+		#
+		for url, isCompressed in ((policy.getURL() + ".gz", True), (policy.getURL(), False)):
+			request = urllib2.Request(url)
+
+			if os.path.exists(cacheFile) and cacheInfo.get('URL') == url:
+				#
+				# Revalidate our copy, Apple's CDN replies with 304 when nothing changed.
+				#
+				if 'ETag' in cacheInfo:
+					request.add_header('If-None-Match', cacheInfo['ETag'])
+				if 'Last-Modified' in cacheInfo:
+					request.add_header('If-Modified-Since', cacheInfo['Last-Modified'])
+			try:
+				catalogReq = urllib2.urlopen(request, timeout=60)
+			except urllib2.HTTPError, error:
+				if error.code == 304:
+					return (openCatalogCache(cacheFile, cacheInfo), False)
+				elif isCompressed and error.code in (403, 404):
+					continue
+			except urllib2.URLError, error:
+				pass
+			break
+
+		if catalogReq:
+			headers = catalogReq.info()
+			cacheInfo = dict(CatalogURL=catalogURL, URL=url, Compressed=isCompressed)
+
+			for header in ('ETag', 'Last-Modified'):
+				if headers.getheader(header):
+					cacheInfo[header] = headers.getheader(header)
+
+			return (CatalogStream(catalogReq, isCompressed, cacheFile, cacheInfo), True)
+		elif policy.failed(error):
+			continue
+		elif isinstance(error, urllib2.HTTPError):
+			print >> sys.stderr, ("\nERROR: opening of (%s) failed with HTTP error %d. Aborting ...\n" % (url, error.code))
+			sys.exit(-1)
+		elif os.path.exists(cacheFile):
+			print >> sys.stderr, ("\nWarning: opening of (%s) failed. Using cached copy ..." % url)
+			return (openCatalogCache(cacheFile, cacheInfo), False)
+
+		print >> sys.stderr, ("\nERROR: opening of (%s) failed. Aborting ...\n" % url)
+		sys.exit(-1)
+
+
+class ProductReader(object):
+	#
+	# Event driven (expat) sucatalog reader. Products are built one at a time and only the ones
+	# accepted by matchProduct() are kept (as compact records), everything else is dropped as soon
+	# as its closing </dict> arrives.
+	#
+	def __init__(self, matchProduct):
+		self.matchProduct = matchProduct
+		self.products = []
+		self.stack = []
+		self.data = []
+		self.parser = expat.ParserCreate()
+		self.parser.buffer_text = True
+		self.parser.StartElementHandler = self.startElement
+		self.parser.EndElementHandler = self.endElement
+		self.parser.CharacterDataHandler = self.data.append
+
+	def feed(self, chunk):
+		self.parser.Parse(chunk, not chunk)
+
+	def startElement(self, tag, attributes):
+		del self.data[:]
+
+		if tag == 'dict':
+			self.stack.append([{}, None])
+		elif tag == 'array':
+			self.stack.append([[], None])
+
+	def endElement(self, tag):
+		text = ''.join(self.data)
+		del self.data[:]
+		# Same as plistlib; plain str for ASCII data.
+		try:
+			text = text.encode('ascii')
+		except UnicodeError:
+			pass
+
+		if tag == 'key':
+			self.stack[-1][1] = text
+			return
+		elif tag in ('dict', 'array'):
+			value = self.stack.pop()[0]
+			#
+			# root <dict> -> Products <dict> -> product <dict>
+			#
+			if tag == 'dict' and len(self.stack) == 2 and self.stack[0][1] == 'Products':
+				key = self.stack[1][1]
+
+				if self.matchProduct(value):
+					self.products.append((key, getProductRecord(value)))
+				return
+		elif tag == 'string':
+			value = text
+		elif tag == 'integer':
+			value = int(text)
+		elif tag == 'real':
+			value = float(text)
+		elif tag == 'true':
+			value = True
+		elif tag == 'false':
+			value = False
+		elif tag == 'date':
+			value = datetime.strptime(text, "%Y-%m-%dT%H:%M:%SZ")
+		elif tag == 'data':
+			value = plistlib.Data.fromBase64(text)
+		else:
+			return
+
+		if self.stack:
+			container, key = self.stack[-1]
+
+			if isinstance(container, list):
+				container.append(value)
+			else:
+				container[key] = value
+
+
+def getProductRecord(product):
+	#
+	# Strip a product down to what we use (no ServerMetadataURL, MetadataURL, State etc).
+	#
+	record = {}
+
+	for key in ('Distributions', 'ExtendedMetaInfo', 'PostDate'):
+		if key in product:
+			record[key] = product[key]
+
+	record['Packages'] = []
+
+	for package in product.get('Packages', []):
+		record['Packages'].append(dict((key, package[key]) for key in ('URL', 'Size', 'Digest') if key in package))
+
+	return record
+
+
+def getProductType(product):
+	extendedMetaInfo = product.get('ExtendedMetaInfo', {})
+	IAPackageIDs = extendedMetaInfo.get('InstallAssistantPackageIdentifiers', {})
+
+	if IAPackageIDs.get('InstallInfo') == 'com.apple.plist.InstallInfo' and IAPackageIDs.get('OSInstall') == 'com.apple.mpkg.OSInstall':
+		return 'install'
+
+	return extendedMetaInfo.get('ProductType')
+
+
+def iterProducts(catalogStream, matchProduct):
+	reader = ProductReader(matchProduct)
+
+	while True:
+		chunk = catalogStream.read(65536)
+		reader.feed(chunk)
+		#
+		# Hand out the matching products while the rest of the catalog is still arriving.
+		#
+		for product in reader.products:
+			yield product
+
+		del reader.products[:]
+
+		if not chunk:
+			break
+
+
+def getVersionKey(version):
+	#
+	# Sortable version ('10.13.3' -> '0010.0013.0003') so that 10.13.10 is newer than 10.13.9.
+	#
+	return '.'.join('%04d' % int(number) for number in re.findall(r'\d+', str(version)))
+
+
+def getBuildKey(build):
+	#
+	# Sortable build ('17D47' -> '0017D00047', '17A291j' -> '0017A00291j').
+	#
+	match = re.match(r'^(\d+)([A-Z])(\d+)([a-z]*)$', str(build))
+
+	if match:
+		return '%04d%s%05d%s' % (int(match.group(1)), match.group(2), int(match.group(3)), match.group(4))
+
+	return ''
+
+
+def openProductIndex():
+	if not os.path.isdir(CACHE_DIRECTORY):
+		os.makedirs(CACHE_DIRECTORY)
+
+	connection = sqlite3.connect(PRODUCT_INDEX, timeout=60)
+	connection.text_factory = str
+	connection.executescript('''
+		CREATE TABLE IF NOT EXISTS catalogs (catalogURL TEXT PRIMARY KEY, revision TEXT);
+		CREATE TABLE IF NOT EXISTS products (catalogURL TEXT, key TEXT, productType TEXT, productVersion TEXT, versionKey TEXT,
+			build TEXT, buildKey TEXT, postDate TEXT, distributions TEXT, PRIMARY KEY (catalogURL, key));
+		CREATE TABLE IF NOT EXISTS packages (catalogURL TEXT, key TEXT, name TEXT, URL TEXT, size INTEGER, digest TEXT);
+		CREATE TABLE IF NOT EXISTS changes (catalogURL TEXT, revision TEXT, detected TEXT, record TEXT);
+		CREATE TABLE IF NOT EXISTS reported (catalogURL TEXT PRIMARY KEY, lastChange INTEGER);
+		CREATE TABLE IF NOT EXISTS distributions (URL TEXT, digest TEXT, info TEXT, PRIMARY KEY (URL, digest));
+		CREATE TABLE IF NOT EXISTS verified (device INTEGER, inode INTEGER, size INTEGER, mtime TEXT, digest TEXT, PRIMARY KEY (device, inode));
+		CREATE INDEX IF NOT EXISTS products_type ON products (productType, versionKey);
+		CREATE INDEX IF NOT EXISTS products_key ON products (key);
+		CREATE INDEX IF NOT EXISTS packages_key ON packages (catalogURL, key);
+		CREATE INDEX IF NOT EXISTS packages_name ON packages (name);
+	''')
+	return connection
+
+
+indexConnections = threading.local()
+
+
+def getIndexConnection():
+	#
+	# One connection per thread (SQLite wants that) and process (the -s workers are forked), instead
+	# of one (and the schema script) per lookup. Reads use fetchall(), so that it holds no read lock.
+	#
+	if getattr(indexConnections, 'pid', None) != os.getpid():
+		indexConnections.connection = openProductIndex()
+		indexConnections.pid = os.getpid()
+
+	return indexConnections.connection
+
+
+def indexProduct(connection, catalogURL, key, product):
+	extendedMetaInfo = product.get('ExtendedMetaInfo', {})
+	productVersion = extendedMetaInfo.get('ProductVersion')
+	versionKey = getVersionKey(productVersion) if productVersion else None
+	#
+	# Update (or insert) the row, without losing the build and version from setProductBuild().
+	#
+	cursor = connection.execute("UPDATE products SET productType = ?, productVersion = COALESCE(?, productVersion), versionKey = COALESCE(?, versionKey), postDate = ?, distributions = ? WHERE catalogURL = ? AND key = ?",
+		(getProductType(product), productVersion, versionKey, str(product.get('PostDate', '')), json.dumps(product.get('Distributions', {})), catalogURL, key))
+
+	if cursor.rowcount == 0:
+		connection.execute("INSERT INTO products VALUES (?, ?, ?, ?, ?, NULL, NULL, ?, ?)",
+			(catalogURL, key, getProductType(product), productVersion, versionKey, str(product.get('PostDate', '')), json.dumps(product.get('Distributions', {}))))
+
+	for package in product['Packages']:
+		connection.execute("INSERT INTO packages VALUES (?, ?, ?, ?, ?, ?)",
+			(catalogURL, key, basename(package.get('URL', '')), package.get('URL'), package.get('Size'), package.get('Digest')))
+
+
+def getCatalogChanges(connection, catalogURL, products):
+	previousPostDates = dict(connection.execute("SELECT key, postDate FROM products WHERE catalogURL = ?", (catalogURL,)).fetchall())
+	changes = []
+
+	for key, product in products:
+		postDate = str(product.get('PostDate', ''))
+		previousPostDate = previousPostDates.pop(key, None)
+		#
+		# Same PostDate means the same product, no need to look any further.
+		#
+		if previousPostDate == postDate:
+			continue
+
+		packageURLs = [package.get('URL') for package in product['Packages']]
+
+		if previousPostDate == None:
+			changes.append(dict(change='added', key=key, postDate=postDate, packages=packageURLs))
+		else:
+			previousURLs = set(URL for URL, in connection.execute("SELECT URL FROM packages WHERE catalogURL = ? AND key = ?", (catalogURL, key)))
+			changes.append(dict(change='changed', key=key, postDate=postDate, previousPostDate=previousPostDate,
+				packages=[URL for URL in packageURLs if URL not in previousURLs]))
+
+	for key, previousPostDate in previousPostDates.items():
+		changes.append(dict(change='removed', key=key, previousPostDate=previousPostDate))
+
+	return changes
+
+
+def diffCatalog(catalogURL):
+	#
+	# Rebuilding the index (new catalog revision) is what records the changes, but any other run
+	# (-s, -j or a download) may have done that already, so report everything since the last -d.
+	#
+	connection = updateProductIndex(catalogURL)
+	row = connection.execute("SELECT lastChange FROM reported WHERE catalogURL = ?", (catalogURL,)).fetchone()
+	lastChange = row[0] if row else 0
+	records = []
+
+	for rowid, record in connection.execute("SELECT rowid, record FROM changes WHERE catalogURL = ? AND rowid > ? ORDER BY rowid", (catalogURL, lastChange)).fetchall():
+		records.append(json.loads(record))
+		lastChange = rowid
+
+	connection.execute("INSERT OR REPLACE INTO reported VALUES (?, ?)", (catalogURL, lastChange))
+	connection.commit()
+	connection.close()
+	return records
+
+
+def updateProductIndex(catalogURL):
+	catalogStream, modified = fetchCatalog(catalogURL)
+	cacheInfo = catalogStream.cacheInfo or {}
+	revision = cacheInfo.get('ETag') or cacheInfo.get('Last-Modified')
+	connection = openProductIndex()
+	row = connection.execute("SELECT revision FROM catalogs WHERE catalogURL = ?", (catalogURL,)).fetchone()
+	#
+	# Same catalog revision? Then the index is up-to-date and we don't have to parse anything.
+	#
+	if revision and row and row[0] == revision:
+		catalogStream.close()
+		return connection
+
+	#
+	# Read (download) the catalog first, so that other processes can still use the index meanwhile.
+	#
+	products = list(iterProducts(catalogStream, lambda product: True))
+
+	with connection:
+		#
+		# The current rows are the snapshot of the previous revision, save the differences first.
+		#
+		if row:
+			for record in getCatalogChanges(connection, catalogURL, products):
+				connection.execute("INSERT INTO changes VALUES (?, ?, ?, ?)", (catalogURL, revision, str(datetime.now()), json.dumps(record)))
+
+		#
+		# Products that are no longer in the catalog go, the others are updated (indexProduct).
+		#
+		keys = set(key for key, product in products)
+		connection.executemany("DELETE FROM products WHERE catalogURL = ? AND key = ?",
+			[(catalogURL, key) for key, in connection.execute("SELECT key FROM products WHERE catalogURL = ?", (catalogURL,)).fetchall() if key not in keys])
+		connection.execute("DELETE FROM packages WHERE catalogURL = ?", (catalogURL,))
+
+		for key, product in products:
+			indexProduct(connection, catalogURL, key, product)
+
+		connection.execute("INSERT OR REPLACE INTO catalogs VALUES (?, ?)", (catalogURL, revision))
+
+	catalogStream.close()
+	return connection
+
+
+def setProductBuild(key, version, build):
+	#
+	# The build (and version of install products) is only known after reading the distribution file.
+	#
+	if not getBuildKey(build):
+		return
+
+	connection = openProductIndex()
+
+	with connection:
+		connection.execute("UPDATE products SET build = ?, buildKey = ?, productVersion = COALESCE(productVersion, ?), versionKey = COALESCE(versionKey, ?) WHERE key = ?",
+			(build, getBuildKey(build), version, getVersionKey(version) if version else None, key))
+
+	connection.close()
+
+
+def compareProducts(product, otherProduct):
+	#
+	# Newest first: by version and then by build, but only when both products have one (unknown
+	# until the distribution file has been read), the PostDate decides otherwise.
+	#
+	for index in (5, 6):
+		if product[index] and otherProduct[index] and product[index] != otherProduct[index]:
+			return cmp(otherProduct[index], product[index])
+
+	return cmp(otherProduct[1], product[1])
+
+
+def findProducts(catalogURL, productType=None, version=None, packageName=None, newerThan=None):
+	#
+	# Examples: findProducts(url, 'install', '10.13') for the 10.13.x installers (newest first) or
+	#           findProducts(url, packageName='FirmwareUpdate.pkg', newerThan='17D47').
+	#
+	connection = updateProductIndex(catalogURL)
+	query = "SELECT key, postDate, distributions, productVersion, build, versionKey, buildKey FROM products WHERE catalogURL = ?"
+	arguments = [catalogURL]
+
+	if productType:
+		query += " AND productType = ?"
+		arguments.append(productType)
+	if version:
+		query += " AND (productVersion = ? OR productVersion LIKE ?)"
+		arguments.extend([version, version + '.%'])
+	if packageName:
+		query += " AND key IN (SELECT key FROM packages WHERE catalogURL = ? AND name = ?)"
+		arguments.extend([catalogURL, packageName])
+	if newerThan:
+		query += " AND buildKey > ?"
+		arguments.append(getBuildKey(newerThan))
+
+	query += " ORDER BY postDate DESC"
+	products = []
+
+	for key, postDate, distributions, productVersion, build, versionKey, buildKey in sorted(connection.execute(query, arguments).fetchall(), cmp=compareProducts):
+		packages = []
+
+		for URL, size, digest in connection.execute("SELECT URL, size, digest FROM packages WHERE catalogURL = ? AND key = ?", (catalogURL, key)):
+			packages.append(dict(URL=URL, Size=size, Digest=digest))
+
+		products.append((key, dict(Distributions=json.loads(distributions), Packages=packages, PostDate=postDate, ProductVersion=productVersion, Build=build)))
+
+	connection.close()
+	return products
+
+
+def getCatalogURL(targetVolume):
+	seedProgram, targetProductVersion = getSeedProgram(targetVolume)
+
+	if seedProgram == None:
+		print "\nERROR: No .SeedEnrollment.plist found. Initialising ..."
+		enrollInSeedProgram(targetVolume, targetProductVersion)
+		seedProgram, targetProductVersion = getSeedProgram(targetVolume)
+
+	catalog = seedProgramData.get(seedProgram, seedProgramData['Regular'])
+	return SUCATALOG_URL + catalog
+
+
+def getProduct(productType, macOSVersion, targetVolume, targetPackageName):
+	packageData = []
+	catalogURL = getCatalogURL(targetVolume)
+
+	if targetPackageName == "*":
+		print "Searching for macOS: %s" % macOSVersion
+	else:
+		print "Searching for: %s for macOS %s" % (targetPackageName, macOSVersion)
+
+	if productType == "install":
+		products = findProducts(catalogURL, 'install')
+	elif productType == "update":
+		products = findProducts(catalogURL, 'macOS', macOSVersion)
+	else:
+		products = []
+
+	for key, product in products:
+		packageData.extend([key, product])
+
+	return packageData
+
+
+def getSeedProgramProducts(argumentData):
+	seedProgram = argumentData[0]
+	languageSelector = argumentData[1]
+	targetVolume = argumentData[2]
+	catalogURL = SUCATALOG_URL + seedProgramData[seedProgram]
+	products = []
+
+	for key, product in findProducts(catalogURL, 'install'):
+		if not product['Build']:
+			#
+			# Unknown build, get it from the distribution file (stored in the index for the next run).
+			#
+			distributionURL = getDistributionURL(product, languageSelector)
+			targetPath = os.path.join(targetVolume, tmpDirectory, key)
+
+			if not distributionURL:
+				continue
+			if not os.path.isdir(targetPath):
+				os.makedirs(targetPath)
+
+			distributionFile = downloadDistributionFile(distributionURL, targetPath)
+
+			if distributionFile == None:
+				# Listed as unknown (and tried again next time), one failed download doesn't end the survey.
+				print >> sys.stderr, ("Warning: no distribution file for %s (%s), build unknown ..." % (key, seedProgram))
+				version, build = ('Unknown', 'Unknown')
+			else:
+				version, build = getBuildAndVersion(distributionFile, "*", "", distributionURL)
+				setProductBuild(key, version, build)
+
+			product['ProductVersion'] = version
+			product['Build'] = build
+
+		products.append((seedProgram, key, product))
+
+	return products
+
+
+def showSeedPrograms(languageSelector, targetVolume):
+	startTime = time.time()
+	seedPrograms = sorted(seedProgramData.keys())
+	argumentData = [[seedProgram, languageSelector, targetVolume] for seedProgram in seedPrograms]
+	# Create the index (schema) here, not in four processes at once.
+	openProductIndex().close()
+	#
+	# One worker per catalog; the total time is that of the slowest catalog (not the sum of all four).
+	#
+	from multiprocessing import Pool
+	p = Pool(len(seedPrograms))
+	results = p.map(getSeedProgramProducts, argumentData)
+	p.close()
+	#
+	# Merged view (product key -> seed programs) and the newest build per seed program.
+	#
+	mergedProducts = {}
+	newestProducts = {}
+
+	for products in results:
+		for seedProgram, key, product in products:
+			mergedProducts.setdefault(key, [product, []])[1].append(seedProgram)
+
+			if seedProgram not in newestProducts or getBuildKey(product['Build']) > getBuildKey(newestProducts[seedProgram][1]['Build']):
+				newestProducts[seedProgram] = (key, product)
+
+	print "\nInstall products:\n"
+
+	for key in sorted(mergedProducts, key=lambda key: getBuildKey(mergedProducts[key][0]['Build']), reverse=True):
+		product, programs = mergedProducts[key]
+		print "%-12s macOS %-8s (%-8s) %s" % (key, product['ProductVersion'], product['Build'], ', '.join(programs))
+
+	print "\nNewest build per seed program:\n"
+
+	for seedProgram in seedPrograms:
+		if seedProgram in newestProducts:
+			key, product = newestProducts[seedProgram]
+			print "%-14s macOS %-8s (%-8s) with key: %s" % (seedProgram, product['ProductVersion'], product['Build'], key)
+		else:
+			print "%-14s no install products found" % seedProgram
+
+	print "\nDone in %.2f seconds" % (time.time() - startTime)
+
+
+def getSeedProgramName(targetVolume):
+	# Like getCatalogURL() but without enrolment (no prompts), falls back to the regular catalog.
+	seedProgram, targetProductVersion = getSeedProgram(targetVolume)
+
+	if seedProgram in seedProgramData:
+		return seedProgram
+
+	return 'Regular'
+
+
+def queryProducts(seedPrograms, productType, version, targetPackageName, languageSelector, targetVolume):
+	records = []
+
+	for seedProgram in seedPrograms:
+		catalogURL = SUCATALOG_URL + seedProgramData[seedProgram]
+		data = []
+
+		for key, product in findProducts(catalogURL, 'install' if productType == 'install' else 'macOS', packageName=targetPackageName):
+			data.extend([key, product])
+
+		distributionFiles = getDistributionFiles(data, targetVolume, languageSelector)
+
+		for index in range(0, len(data), 2):
+			key = data[index]
+			product = data[index+1]
+			distributionFile = distributionFiles[index/2]
+
+			if distributionFile == None:
+				continue
+
+			distributionURL = getDistributionURL(product, languageSelector)
+			productVersion, build = getBuildAndVersion(distributionFile, targetPackageName or '*', '', distributionURL)
+
+			if productType == 'update' and productVersion == 0:
+				productVersion = product['ProductVersion']
+
+			setProductBuild(key, productVersion, build)
+			#
+			# Version filter: 10.13 matches 10.13, 10.13.1 etc.
+			#
+			if version:
+				versionKey = getVersionKey(version)
+				productVersionKey = getVersionKey(productVersion)
+
+				if productVersionKey != versionKey and not productVersionKey.startswith(versionKey + '.'):
+					continue
+
+			packages = []
+
+			for package in product['Packages']:
+				packages.append(dict(name=basename(package['URL']), URL=package['URL'], size=package.get('Size'), digest=package.get('Digest')))
+
+			records.append(dict(seedProgram=seedProgram, key=key, version=productVersion, build=build, postDate=product['PostDate'],
+				beta=isBetaSeed(distributionFile, distributionURL), packages=packages))
+
+	return records
+
+
+def readJournal(targetFilename):
+	try:
+		with open(targetFilename + ".journal", 'r') as file:
+			return json.load(file)
+	except (IOError, ValueError):
+		return None
+
+
+def writeJournal(targetFilename, journal):
+	# Write and rename, a crash never leaves a half written journal behind.
+	with open(targetFilename + ".journal.tmp", 'w') as file:
+		json.dump(journal, file)
+	os.rename(targetFilename + ".journal.tmp", targetFilename + ".journal")
+
+
+def getChunklistFilename(filename):
+	# AppleDiagnostics.dmg -> AppleDiagnostics.chunklist, InstallESDDmg.pkg -> InstallESDDmg.chunklist
+	return os.path.splitext(filename)[0] + ".chunklist"
+
+
+def readChunklist(chunklistFile):
+	#
+	# A chunklist starts with a 36 byte header: magic (CNKL), header size, file version, chunk method,
+	# signature method, padding, chunk count, chunk offset and signature offset. The chunk entries
+	# are a (uint32) chunk size and the SHA-256 of that chunk. Returns [(offset, size, digest), ...]
+	#
+	try:
+		with open(chunklistFile, 'rb') as file:
+			data = file.read()
+	except IOError:
+		return None
+
+	if len(data) < 36:
+		return None
+
+	magic, headerSize, fileVersion, chunkMethod, signatureMethod, padding, totalChunks, chunkOffset, signatureOffset = struct.unpack('<IIBBBBQQQ', data[:36])
+
+	if magic != CHUNKLIST_MAGIC or chunkMethod != 1 or (chunkOffset + (totalChunks * 36)) > len(data):
+		return None
+
+	chunks = []
+	offset = 0
+
+	for index in range(totalChunks):
+		size, digest = struct.unpack_from('<I32s', data, chunkOffset + (index * 36))
+		chunks.append((offset, size, digest))
+		offset += size
+
+	return chunks
+
+
+def getChunks(filename, filesize):
+	# Chunklist for this file, but only when it covers the whole file.
+	if filename.endswith(".chunklist"):
+		return None
+
+	chunks = readChunklist(getChunklistFilename(filename))
+
+	if chunks and (chunks[-1][0] + chunks[-1][1]) == filesize:
+		return chunks
+
+	return None
+
+
+def verifyChunklist(filename, chunks):
+	#
+	# Hash all chunks, in parallel, straight from a read-only mmap of the file. Returns the offsets
+	# of the chunks that failed (chunks past the end of the file included).
+	#
+	filesize = os.path.getsize(filename)
+	failed = [chunk[0] for chunk in chunks if (chunk[0] + chunk[1]) > filesize]
+	chunks = [chunk for chunk in chunks if (chunk[0] + chunk[1]) <= filesize]
+
+	if chunks and filesize:
+		with open(filename, 'rb') as file:
+			fileMap = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+		from multiprocessing import cpu_count
+		from multiprocessing.pool import ThreadPool
+		#
+		# No need for processes, hashlib releases the GIL while hashing (large) buffers.
+		#
+		p = ThreadPool(cpu_count())
+		digests = p.map(lambda chunk: hashlib.sha256(buffer(fileMap, chunk[0], chunk[1])).digest(), chunks)
+		p.close()
+		fileMap.close()
+		failed = [chunk[0] for chunk, digest in zip(chunks, digests) if digest != chunk[2]] + failed
+
+	return failed
+
+
+class ChunklistVerifier(object):
+	#
+	# Streaming mode: fed with the bytes in the order of the file (as they arrive from the server),
+	# and every completed chunk is checked right away. When the first offset isn't the start of a
+	# chunk then the part of the chunk that is already on disk will be read from the file first.
+	#
+	def __init__(self, chunks, filename, offset):
+		self.chunks = chunks
+		self.index = 0
+		self.failed = None
+
+		while self.index < len(chunks) and (chunks[self.index][0] + chunks[self.index][1]) <= offset:
+			self.index += 1
+
+		self.hash = hashlib.sha256()
+
+		if self.index < len(chunks):
+			self.left = chunks[self.index][1]
+			chunkStart = chunks[self.index][0]
+
+			if chunkStart < offset:
+				with open(filename, 'rb') as file:
+					file.seek(chunkStart)
+					self.update(file.read(offset - chunkStart))
+
+	def update(self, data):
+		data = memoryview(data)
+		position = 0
+
+		while position < len(data) and self.index < len(self.chunks):
+			length = min(self.left, len(data) - position)
+			self.hash.update(data[position:position + length])
+			position += length
+			self.left -= length
+
+			if self.left == 0:
+				if self.hash.digest() != self.chunks[self.index][2]:
+					# Offset of the bad chunk (where the download has to start again).
+					self.failed = self.chunks[self.index][0]
+					return False
+
+				self.index += 1
+				self.hash = hashlib.sha256()
+
+				if self.index < len(self.chunks):
+					self.left = self.chunks[self.index][1]
+
+		return True
+
+
+class PooledResponse(object):
+	#
+	# What urllib2.urlopen() returns (getcode, info, read and close) for a pooled connection. The
+	# connection goes back to the pool on close(), but only when the whole response was read.
+	#
+	def __init__(self, pool, key, connection, response):
+		self.pool = pool
+		self.key = key
+		self.connection = connection
+		self.response = response
+
+	def getcode(self):
+		return self.response.status
+
+	def info(self):
+		return self.response.msg
+
+	def read(self, size=None):
+		if size == None:
+			return self.response.read()
+		return self.response.read(size)
+
+	def readinto(self, view):
+		#
+		# Straight from the socket into the caller's buffer (no new string for every read) when the
+		# body has a Content-Length and nothing is buffered in the (unbuffered) file object.
+		#
+		response = self.response
+		fp = response.fp
+
+		if fp == None or response.chunked or response.length == None or fp._rbuf.getvalue():
+			data = response.read(len(view))
+			view[:len(data)] = data
+			return len(data)
+
+		size = min(len(view), response.length)
+		received = 0
+
+		while received < size:
+			count = fp._sock.recv_into(view[received:size])
+			if not count:
+				break
+			received += count
+
+		response.length -= received
+
+		if not response.length or not received:
+			response.close()
+
+		return received
+
+	def close(self):
+		if self.connection:
+			self.pool.release(self.key, self.connection, self.response.isclosed())
+			self.connection = None
+
+
+class ConnectionPool(object):
+	#
+	# Keep-alive (httplib) connections per scheme and host, shared by the download threads, so that
+	# we don't pay for a new TCP connection and TLS handshake for every file (and segment). No more
+	# than maxPerHost connections to a host are in use at any time, callers wait for their turn.
+	#
+	def __init__(self, maxPerHost):
+		self.maxPerHost = maxPerHost
+		self.condition = threading.Condition()
+		self.idle = {}
+		self.active = {}
+
+	def acquire(self, key):
+		with self.condition:
+			while self.active.get(key, 0) >= self.maxPerHost:
+				self.condition.wait(1)
+
+			self.active[key] = self.active.get(key, 0) + 1
+
+			if self.idle.get(key):
+				return self.idle[key].pop()
+
+		if key[0] == 'https':
+			return httplib.HTTPSConnection(key[1], timeout=60)
+
+		return httplib.HTTPConnection(key[1], timeout=60)
+
+	def release(self, key, connection, reuse):
+		if not reuse:
+			connection.close()
+
+		with self.condition:
+			self.active[key] -= 1
+
+			if reuse:
+				self.idle.setdefault(key, []).append(connection)
+
+			self.condition.notify()
+
+	def urlopen(self, url, headers={}):
+		#
+		# Like urllib2.urlopen(): redirects are followed and HTTP errors raise urllib2.HTTPError.
+		#
+		for redirect in range(5):
+			parts = urlparse.urlsplit(url)
+
+			if parts.scheme in urllib.getproxies():
+				# Leave proxies to urllib2.
+				return urllib2.urlopen(urllib2.Request(url, headers=headers), timeout=60)
+
+			key = (parts.scheme, parts.netloc)
+			connection = self.acquire(key)
+
+			for attempt in range(2):
+				try:
+					connection.request('GET', parts.path + ('?' + parts.query if parts.query else ''), headers=headers)
+					response = connection.getresponse()
+					break
+				except (socket.error, httplib.HTTPException), error:
+					#
+					# The server may have closed our idle connection, try once more with a new one.
+					#
+					connection.close()
+
+					if attempt:
+						self.release(key, connection, False)
+						raise urllib2.URLError(error)
+
+			if response.status in (301, 302, 303, 307, 308) and response.getheader('Location'):
+				response.read()
+				self.release(key, connection, response.isclosed())
+				url = urlparse.urljoin(url, response.getheader('Location'))
+				continue
+
+			if response.status >= 400:
+				response.read()
+				self.release(key, connection, response.isclosed())
+				raise urllib2.HTTPError(url, response.status, response.reason, response.msg, None)
+
+			return PooledResponse(self, key, connection, response)
+
+		raise urllib2.URLError("too many redirects")
+
+
+connectionPool = ConnectionPool(HOST_CONNECTIONS)
+
+
+def getOriginalURL(url):
+	# http://<mirror>/<scheme>/<host>/<path> (one of our mirrors) to <scheme>://<host>/<path>
+	for mirrorURL in MIRROR_URLS:
+		prefix = mirrorURL.rstrip('/') + '/'
+
+		if url.startswith(prefix):
+			parts = url[len(prefix):].split('/', 2)
+
+			if len(parts) == 3 and parts[0] in ('http', 'https'):
+				return "%s://%s/%s" % tuple(parts)
+
+	return url
+
+
+def getSourceURLs(url):
+	#
+	# Where a file can be downloaded from: the mirrors (-r and -F, in that order) first, then the
+	# original URL (Apple).
+	#
+	originalURL = getOriginalURL(url)
+	urls = []
+
+	for sourceURL in [getMirroredURL(mirrorURL, originalURL) for mirrorURL in MIRROR_URLS] + [originalURL]:
+		if sourceURL not in urls:
+			urls.append(sourceURL)
+
+	return urls
+
+
+def classifyError(error):
+	#
+	# 'retry' (same source, after a pause) for timeouts, dropped connections, 408, 429 and 5xx.
+	# 'failover' (next source, right away) when the source can't help us: any other 4xx, unknown
+	# host or a refused connection (mirror not running).
+	#
+	if isinstance(error, urllib2.HTTPError):
+		if error.code in (408, 429) or error.code >= 500:
+			return 'retry'
+		return 'failover'
+
+	reason = getattr(error, 'reason', error)
+
+	if isinstance(reason, socket.gaierror) or getattr(reason, 'errno', None) in (errno.ECONNREFUSED, errno.EHOSTUNREACH, errno.ENETUNREACH):
+		return 'failover'
+
+	return 'retry'
+
+
+class RetryPolicy(object):
+	#
+	# One per transfer (or segment). Transient errors are retried on the same source after a jittered
+	# exponential backoff (or Retry-After), the next source takes over after RETRY_ATTEMPTS errors in
+	# a row, or right away when the source doesn't have the file. Progress resets the count.
+	#
+	def __init__(self, url):
+		self.urls = getSourceURLs(url)
+		self.index = 0
+		self.attempts = 0
+
+	def getURL(self):
+		return self.urls[self.index]
+
+	def failed(self, error):
+		# Returns False when there's nothing left to try.
+		self.attempts += 1
+		filename = basename(self.getURL())
+
+		if classifyError(error) == 'failover' or self.attempts >= RETRY_ATTEMPTS:
+			if self.index + 1 >= len(self.urls):
+				return False
+
+			self.index += 1
+			self.attempts = 0
+			downloadMonitor.log("Warning: %s failed (%s), switching to %s ..." % (filename, error, self.getURL()), sys.stderr)
+			return True
+
+		concurrencyController.failed()
+		delay = random.uniform(0, min(RETRY_MAX_DELAY, RETRY_DELAY * 2 ** (self.attempts - 1)))
+		retryAfter = getattr(error, 'hdrs', None) and error.hdrs.getheader('Retry-After')
+
+		if retryAfter and retryAfter.isdigit():
+			delay = min(int(retryAfter), RETRY_MAX_DELAY)
+
+		downloadMonitor.log("Warning: %s failed (%s), retrying in %.1f seconds ..." % (filename, error, delay), sys.stderr)
+		time.sleep(delay)
+		return True
+
+	def succeeded(self):
+		self.attempts = 0
+
+
+def checkContentRange(response, start, filesize):
+	# bytes <start>-<end>/<size>, starting where we asked and of the size that we expect.
+	match = re.match(r'^bytes (\d+)-(\d+)/(\d+|\*)$', response.info().getheader('Content-Range') or '')
+	return match != None and int(match.group(1)) == start and (not filesize or match.group(3) == '*' or int(match.group(3)) == filesize)
+
+
+def setJournalSource(journal, sourceURL, headers):
+	# The file comes from sourceURL (from the start), If-Range only works with its validators.
+	journal['Source'] = sourceURL
+
+	for header in ('ETag', 'Last-Modified'):
+		if headers.getheader(header):
+			journal[header] = headers.getheader(header)
+		elif header in journal:
+			del journal[header]
+
+
+def openDownload(policy, journal, start, end, filesize, requireRange):
+	#
+	# GET from start (to end, or the end of the file) from the first source that works, as the policy
+	# says. If-Range is only sent to the source of the journal's validators, partial responses from
+	# other sources are checked with Content-Range instead. requireRange makes anything but 206 an
+	# error (segments), otherwise a download that starts from the start has a new source.
+	#
+	while True:
+		sourceURL = policy.getURL()
+		headers = {}
+
+		if start or end != None:
+			headers['Range'] = 'bytes=%d-%s' % (start, '' if end == None else end - 1)
+			validator = journal.get('ETag') or journal.get('Last-Modified')
+
+			if validator and journal.get('Source', journal.get('URL')) == sourceURL:
+				headers['If-Range'] = validator
+		try:
+			response = connectionPool.urlopen(sourceURL, headers)
+
+			if response.getcode() == 206 and not checkContentRange(response, start, filesize):
+				response.close()
+				raise urllib2.HTTPError(sourceURL, 416, "Content-Range mismatch", response.info(), None)
+			elif requireRange and response.getcode() != 206:
+				response.close()
+				raise urllib2.HTTPError(sourceURL, 416, "No Range support (or a different file)", response.info(), None)
+		except (urllib2.URLError, IOError, httplib.HTTPException), error:
+			if policy.failed(error):
+				continue
+			raise
+
+		if not requireRange and (start == 0 or response.getcode() != 206):
+			setJournalSource(journal, sourceURL, response.info())
+
+		return response
+
+
+downloadBuffers = threading.local()
+
+
+def getDownloadBuffer():
+	# One (reusable) read buffer per download thread.
+	if getattr(downloadBuffers, 'size', 0) != DOWNLOAD_BUFFER_SIZE:
+		downloadBuffers.view = memoryview(bytearray(DOWNLOAD_BUFFER_SIZE))
+		downloadBuffers.size = DOWNLOAD_BUFFER_SIZE
+	return downloadBuffers.view
+
+
+def readInto(response, view):
+	if hasattr(response, 'readinto'):
+		return response.readinto(view)
+	# urllib2 (proxy) response.
+	data = response.read(len(view))
+	view[:len(data)] = data
+	return len(data)
+
+
+def preallocateFile(file, size):
+	#
+	# Reserve the disk space for the whole file up front (F_PREALLOCATE on macOS, posix_fallocate
+	# elsewhere) instead of growing the file with every write, and set the file size.
+	#
+	file.flush()
+	try:
+		import ctypes
+		import ctypes.util
+		libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+
+		if sys.platform == 'darwin':
+			class fstore_t(ctypes.Structure):
+				_fields_ = [('fst_flags', ctypes.c_uint), ('fst_posmode', ctypes.c_int), ('fst_offset', ctypes.c_longlong), ('fst_length', ctypes.c_longlong), ('fst_bytesalloc', ctypes.c_longlong)]
+			# F_ALLOCATEALL from the physical end of the file (F_PEOFPOSMODE).
+			store = fstore_t(4, 3, 0, size - os.fstat(file.fileno()).st_size, 0)
+			# F_PREALLOCATE
+			libc.fcntl(file.fileno(), 42, ctypes.byref(store))
+		else:
+			libc.posix_fallocate(file.fileno(), ctypes.c_longlong(0), ctypes.c_longlong(size))
+	except (OSError, AttributeError):
+		pass
+
+	file.truncate(size)
+
+
+class DownloadMonitor(object):
+	#
+	# Bytes, rate and ETA of every download (and all of them together). Shown on a status line
+	# that is refreshed in place (when stdout is a terminal), and written to a telemetry file
+	# every second: JSON lines, or the Prometheus text format when the filename ends with .prom
+	#
+	def __init__(self):
+		self.lock = threading.Lock()
+		# Counters only, never held for I/O (the segments of one file update the same counters).
+		self.counterLock = threading.Lock()
+		self.files = {}
+		self.order = []
+		self.telemetryFile = None
+		self.thread = None
+		self.stopped = threading.Event()
+		self.statusLine = False
+
+	def start(self, downloads, telemetryFile):
+		with self.lock:
+			for args in downloads:
+				self.files[args[1]] = dict(file=basename(args[1]), size=args[2] or 0, written=0, received=0, rate=0.0, status='queued',
+					lastReceived=0, lastTime=time.time(), lastData=time.time())
+				self.order.append(args[1])
+
+		self.telemetryFile = telemetryFile
+		self.statusLine = sys.stdout.isatty()
+		self.stopped.clear()
+		self.thread = threading.Thread(target=self.run)
+		self.thread.daemon = True
+		self.thread.start()
+
+	def stop(self):
+		self.stopped.set()
+
+		if self.thread:
+			self.thread.join()
+			self.thread = None
+
+		self.report()
+
+		with self.lock:
+			if self.statusLine:
+				sys.stdout.write("\r\033[K")
+				sys.stdout.flush()
+			self.statusLine = False
+			self.files = {}
+			self.order = []
+
+	def begin(self, targetFilename, written):
+		with self.lock:
+			if targetFilename in self.files:
+				file = self.files[targetFilename]
+
+				with self.counterLock:
+					file['written'] = written
+
+				file['status'] = 'downloading'
+				file['lastTime'] = file['lastData'] = time.time()
+
+	def update(self, targetFilename, count):
+		# Called for every read, so nothing but two additions (under the counter lock).
+		file = self.files.get(targetFilename)
+
+		if file:
+			with self.counterLock:
+				file['written'] += count
+				file['received'] += count
+
+	def finish(self, targetFilename, status, written):
+		with self.lock:
+			if targetFilename in self.files:
+				self.files[targetFilename]['status'] = status
+
+				with self.counterLock:
+					self.files[targetFilename]['written'] = written
+
+				self.files[targetFilename]['rate'] = 0.0
+
+	def log(self, message, stream=None):
+		#
+		# Messages go above the status line.
+		#
+		with self.lock:
+			if self.statusLine:
+				sys.stdout.write("\r\033[K")
+				sys.stdout.flush()
+			print >> (stream or sys.stdout), message
+			(stream or sys.stdout).flush()
+
+	def run(self):
+		while not self.stopped.wait(1):
+			self.report()
+
+	def getSnapshot(self):
+		now = time.time()
+		files = []
+		totals = dict(size=0, written=0, received=0, rate=0.0)
+
+		for targetFilename in self.order:
+			file = self.files[targetFilename]
+
+			if file['status'] == 'downloading':
+				received = file['received']
+
+				if received != file['lastReceived']:
+					file['lastData'] = now
+				# Smoothed rate (bytes per second).
+				rate = (received - file['lastReceived']) / max(now - file['lastTime'], 0.001)
+				file['rate'] = rate if file['lastReceived'] == 0 else (0.3 * rate) + (0.7 * file['rate'])
+				file['lastReceived'] = received
+				file['lastTime'] = now
+
+			left = max(file['size'] - file['written'], 0)
+			eta = int(left / file['rate']) if file['rate'] > 0 else None
+			stalled = int(now - file['lastData']) if file['status'] == 'downloading' else 0
+			files.append(dict(file=file['file'], size=file['size'], written=file['written'], received=file['received'], rate=int(file['rate']),
+				eta=eta, stalled=stalled, status=file['status']))
+
+			if file['status'] != 'skipped':
+				totals['size'] += file['size']
+				totals['written'] += file['written']
+				totals['received'] += file['received']
+				totals['rate'] += file['rate']
+
+		left = max(totals['size'] - totals['written'], 0)
+		totals['eta'] = int(left / totals['rate']) if totals['rate'] > 0 else None
+		totals['rate'] = int(totals['rate'])
+		return (now, totals, files)
+
+	def report(self):
+		with self.lock:
+			if not self.files:
+				return
+
+			now, totals, files = self.getSnapshot()
+
+			if self.statusLine:
+				sys.stdout.write("\r\033[K" + self.getStatusText(totals, files))
+				sys.stdout.flush()
+
+		if self.telemetryFile:
+			try:
+				self.writeTelemetry(now, totals, files)
+			except (IOError, OSError):
+				pass
+
+	def getStatusText(self, totals, files):
+		if totals['size']:
+			text = "Downloading: %d%% %.1f of %.1f MB" % ((totals['written'] * 100) / totals['size'], totals['written'] / 1048576.0, totals['size'] / 1048576.0)
+		else:
+			text = "Downloading: %.1f MB" % (totals['written'] / 1048576.0)
+
+		text += " at %.1f MB/s" % (totals['rate'] / 1048576.0)
+
+		if totals['eta'] != None:
+			text += ", ETA %d:%02d:%02d" % (totals['eta'] / 3600, (totals['eta'] / 60) % 60, totals['eta'] % 60)
+
+		for file in files:
+			if file['status'] == 'downloading':
+				if file['stalled'] >= 10:
+					text += " | %s stalled (%ds)" % (file['file'], file['stalled'])
+				elif file['size']:
+					text += " | %s %d%%" % (file['file'], (file['written'] * 100) / file['size'])
+		#
+		# One line, no wrapping (or it can't be refreshed in place).
+		#
+		return text[:getTerminalWidth() - 1]
+
+	def writeTelemetry(self, now, totals, files):
+		if self.telemetryFile.endswith(".prom"):
+			#
+			# Prometheus text format (the node_exporter textfile collector reads it), replaced as a whole.
+			#
+			lines = []
+
+			for name, help, key in (('written_bytes', "Bytes written to the target file", 'written'), ('size_bytes', "Size of the file (from the catalog)", 'size'),
+				('received_bytes', "Bytes received by this run", 'received'), ('rate_bytes_per_second', "Download rate", 'rate'),
+				('eta_seconds', "Estimated time left", 'eta'), ('stalled_seconds', "Seconds since the last data arrived", 'stalled')):
+				lines.append("# HELP installseed_download_%s %s" % (name, help))
+				lines.append("# TYPE installseed_download_%s gauge" % name)
+
+				for file in files:
+					if file[key] != None:
+						lines.append('installseed_download_%s{file="%s",status="%s"} %s' % (name, file['file'], file['status'], file[key]))
+
+				if key in totals and totals[key] != None:
+					lines.append("# HELP installseed_downloads_%s %s (all files)" % (name, help))
+					lines.append("# TYPE installseed_downloads_%s gauge" % name)
+					lines.append("installseed_downloads_%s %s" % (name, totals[key]))
+
+			with open(self.telemetryFile + ".tmp", 'w') as file:
+				file.write("\n".join(lines) + "\n")
+
+			os.rename(self.telemetryFile + ".tmp", self.telemetryFile)
+		else:
+			with open(self.telemetryFile, 'a') as file:
+				record = dict(time=now, files=files)
+				record.update(totals)
+				file.write(json.dumps(record, sort_keys=True) + "\n")
+
+
+def getTerminalWidth():
+	try:
+		import fcntl
+		import termios
+		return struct.unpack('hh', fcntl.ioctl(sys.stdout.fileno(), termios.TIOCGWINSZ, '1234'))[1] or 80
+	except (ImportError, IOError, struct.error):
+		return 80
+
+
+downloadMonitor = DownloadMonitor()
+
+
+class BandwidthLimiter(object):
+	#
+	# Token bucket (rate bytes per second, one second burst) shared by all download threads. With a
+	# schedule (start and end minute of the day) the limit only applies in that time window.
+	#
+	def __init__(self, rate, schedule=None):
+		self.rate = rate
+		self.schedule = schedule
+		self.lock = threading.Lock()
+		self.tokens = rate
+		self.lastTime = time.time()
+
+	def isActive(self):
+		if not self.rate:
+			return False
+
+		if self.schedule:
+			now = datetime.now()
+			minute = (now.hour * 60) + now.minute
+			start, end = self.schedule
+			#
+			# Windows like 22:00-06:00 wrap around midnight.
+			#
+			if start <= end:
+				return start <= minute < end
+
+			return minute >= start or minute < end
+
+		return True
+
+	def consume(self, count):
+		if not self.isActive():
+			return
+
+		with self.lock:
+			now = time.time()
+			self.tokens = min(self.rate, self.tokens + ((now - self.lastTime) * self.rate))
+			self.lastTime = now
+			self.tokens -= count
+			wait = (-self.tokens / float(self.rate)) if self.tokens < 0 else 0
+		#
+		# Bytes are taken on credit, the thread sleeps until they're paid for.
+		#
+		if wait:
+			time.sleep(wait)
+
+
+bandwidthLimiter = BandwidthLimiter(0)
+
+
+def startGovernor(argument):
+	#
+	# Governor mode: -g <rate>[@HH:MM-HH:MM] with the rate in bytes per second (K, M or G suffix, 0 for
+	# no limit). Returns False for an invalid argument.
+	#
+	global bandwidthLimiter
+	match = re.match(r'^(\d+(?:\.\d+)?)([KMG]?)(?:@(\d{1,2}):(\d{2})-(\d{1,2}):(\d{2}))?$', argument, re.IGNORECASE)
+
+	if not match:
+		return False
+
+	rate = int(float(match.group(1)) * {'': 1, 'K': 1024, 'M': 1048576, 'G': 1073741824}[match.group(2).upper()])
+	schedule = None
+
+	if match.group(3):
+		schedule = ((int(match.group(3)) * 60) + int(match.group(4)), (int(match.group(5)) * 60) + int(match.group(6)))
+
+	bandwidthLimiter = BandwidthLimiter(rate, schedule)
+	lowerPriority()
+	return True
+
+
+def lowerPriority():
+	#
+	# Lower the CPU (nice) and disk I/O priority of this process. Both are inherited by the processes
+	# that we start (pkgutil, cp, installer) so expansion and copying run in the background as well.
+	#
+	try:
+		os.nice(10)
+	except OSError:
+		pass
+
+	if sys.platform == 'darwin':
+		try:
+			import ctypes
+			import ctypes.util
+			libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+			# IOPOL_TYPE_DISK, IOPOL_SCOPE_PROCESS, IOPOL_THROTTLE
+			libc.setiopolicy_np(0, 0, 3)
+		except (OSError, AttributeError):
+			pass
+
+
+class ConcurrencyController(object):
+	#
+	# AIMD for the number of active streams (single stream downloads and segments, one connection
+	# each), between minimum and maximum. The aggregate throughput is measured every interval: one
+	# more stream as long as that pays off (5% or more), one less when it didn't (tried again after
+	# six intervals), half as many after transient errors or when the throughput drops by 30% or
+	# more. Streams over the limit are parked: the connection is closed and the download continues
+	# at the same offset when it's their turn again. Streams get their turn in order of arrival.
+	#
+	def __init__(self, streams):
+		self.minimum = self.maximum = self.limit = streams
+		self.condition = threading.Condition()
+		self.active = 0
+		self.waiting = []
+		self.nextTicket = 0
+		self.received = 0
+		self.errors = 0
+		self.thread = None
+		self.stopped = threading.Event()
+
+	def start(self, minimum, maximum, streams):
+		with self.condition:
+			self.minimum = minimum
+			self.maximum = maximum
+			self.limit = max(minimum, min(streams, maximum))
+			self.lastRate = None
+			# Last decision was an increase (probe), and intervals since the last probe.
+			self.probe = False
+			self.holds = 6
+			self.decision = None
+
+		if minimum < maximum:
+			self.stopped.clear()
+			self.thread = threading.Thread(target=self.run)
+			self.thread.daemon = True
+			self.thread.start()
+
+	def stop(self):
+		self.stopped.set()
+
+		if self.thread:
+			self.thread.join()
+			self.thread = None
+
+	def acquire(self):
+		with self.condition:
+			ticket = self.nextTicket
+			self.nextTicket += 1
+			self.waiting.append(ticket)
+
+			while self.active >= self.limit or self.waiting[0] != ticket:
+				self.condition.wait(1)
+
+			self.waiting.pop(0)
+			self.active += 1
+			# The next one in line may fit as well.
+			self.condition.notifyAll()
+
+	def release(self):
+		with self.condition:
+			self.active -= 1
+			self.condition.notifyAll()
+
+	def transfer(self, count):
+		# Called for every read (of every stream), returns True when this stream should make room.
+		with self.condition:
+			self.received += count
+			return self.active > self.limit
+
+	def park(self):
+		# Back in line (when we're still over the limit), returns when it's our turn again.
+		with self.condition:
+			if self.active <= self.limit:
+				return
+
+			self.active -= 1
+			self.condition.notifyAll()
+
+		self.acquire()
+
+	def failed(self):
+		# Transient download errors (a sign of too many streams).
+		with self.condition:
+			self.errors += 1
+
+	def getReceived(self):
+		with self.condition:
+			return self.received
+
+	def run(self):
+		lastReceived = self.getReceived()
+		lastTime = time.time()
+
+		while not self.stopped.wait(CONCURRENCY_INTERVAL):
+			now = time.time()
+			received = self.getReceived()
+			self.adjust((received - lastReceived) / max(now - lastTime, 0.001))
+			lastReceived = received
+			lastTime = now
+
+	def adjust(self, rate):
+		#
+		# One decision per interval. Logged when the limit or the kind of decision changes (so that
+		# the log shows every decision without repeating a long run of holds).
+		#
+		with self.condition:
+			limit = self.limit
+			# Streams are waiting for their turn (more would be used, and we'd see the difference).
+			busy = len(self.waiting) > 0
+			errors = self.errors
+			self.errors = 0
+
+			measure = False
+
+			if errors or (busy and self.lastRate and rate < (self.lastRate * 0.7)):
+				decision = ("%d errors" % errors if errors else "throughput dropped") + ", decrease"
+				limit = max(self.minimum, limit / 2)
+				self.probe = False
+				self.holds = 0
+				# The next interval only measures (the new baseline).
+				measure = True
+			elif self.lastRate == None:
+				decision = "measuring"
+			elif self.probe and rate < (self.lastRate * 1.05):
+				decision = "no gain, back off"
+				limit = max(self.minimum, limit - 1)
+				self.probe = False
+				self.holds = 0
+			elif busy and limit < self.maximum and (self.probe or self.holds >= 6):
+				decision = "increase"
+				limit += 1
+				self.probe = True
+			else:
+				decision = "hold"
+				self.probe = False
+				self.holds += 1
+
+			if limit != self.limit or decision != self.decision:
+				downloadMonitor.log("Streams: %d -> %d (%s at %.1f MB/s, %d active, %d waiting)" % (self.limit, limit, decision, rate / 1048576.0, self.active, len(self.waiting)))
+
+			self.decision = decision
+			self.lastRate = None if measure else rate
+			self.limit = limit
+			self.condition.notifyAll()
+
+
+concurrencyController = ConcurrencyController(STREAMS_MAX)
+
+
+class DigestVerifier(object):
+	#
+	# SHA-1 of a download (the catalog Digest), computed on its own thread while the data comes in
+	# (hashlib releases the GIL, so hashing overlaps with the network I/O). Single stream downloads
+	# hand over their read buffers (a small ring of buffers, nothing is copied). Segmented downloads
+	# are hashed right behind the contiguous part of the file that has been written (page cache).
+	# Resumed downloads hash the part that was already on disk first.
+	#
+	def __init__(self, filename, offset=0, segments=None):
+		self.filename = filename
+		self.offset = offset
+		self.segments = segments
+		self.hash = hashlib.sha1()
+		self.queue = Queue.Queue()
+		self.free = Queue.Queue()
+		self.stopped = threading.Event()
+		self.aborted = False
+
+		if segments == None:
+			for index in range(4):
+				self.free.put(memoryview(bytearray(DOWNLOAD_BUFFER_SIZE)))
+
+		self.thread = threading.Thread(target=self.run)
+		self.thread.daemon = True
+		self.thread.start()
+
+	def getBuffer(self):
+		# Blocks when the hashing thread is behind.
+		return self.free.get()
+
+	def update(self, data, view):
+		self.queue.put((data, view))
+
+	def run(self):
+		# Unbuffered, a read ahead would see parts of the file that haven't been written yet.
+		with open(self.filename, 'rb', 0) as file:
+			if self.segments == None:
+				self.hashFile(file, self.offset)
+
+				while True:
+					item = self.queue.get()
+
+					if item == None:
+						break
+
+					self.hash.update(item[0])
+					self.free.put(item[1])
+			else:
+				while not self.aborted:
+					if not self.hashFile(file, self.getContiguousSize()):
+						if self.stopped.is_set():
+							break
+						self.stopped.wait(0.1)
+
+	def hashFile(self, file, size):
+		# From where we are up to size, returns the number of bytes hashed.
+		hashed = 0
+
+		while file.tell() < size and not self.aborted:
+			data = file.read(min(size - file.tell(), 1048576))
+
+			if not data:
+				break
+
+			self.hash.update(data)
+			hashed += len(data)
+
+		return hashed
+
+	def getContiguousSize(self):
+		size = 0
+
+		for segment in self.segments:
+			size = segment[2]
+
+			if segment[2] < segment[1]:
+				break
+
+		return size
+
+	def finish(self):
+		# Returns the hex digest (everything was written).
+		self.queue.put(None)
+		self.stopped.set()
+		self.thread.join()
+		return self.hash.hexdigest()
+
+	def abort(self):
+		self.aborted = True
+		self.queue.put(None)
+		self.stopped.set()
+		self.thread.join()
+
+
+def downloadSegment(url, targetFilename, segment, journal, response, reportProgress, chunks, changed):
+	#
+	# Fetch one [start, end, position] segment over its own connection, and write it into the
+	# (preallocated) target file with its own file handle at the segment's position. Segments
+	# start on a chunk boundary, so each segment verifies its own chunks (when we have them).
+	# Dropped connections are retried (or another source takes over) from the current position.
+	# The stream slot (concurrency controller) comes with the response, or we wait for one here.
+	# The changed event is set when the file on the server is no longer the one we have a part of.
+	#
+	if response == None:
+		concurrencyController.acquire()
+
+	policy = RetryPolicy(url)
+	position = segment[2]
+	verifier = ChunklistVerifier(chunks, targetFilename, position) if chunks else None
+	view = getDownloadBuffer()
+
+	with open(targetFilename, 'r+b') as file:
+		file.seek(position)
+
+		while position < segment[1]:
+			if response == None:
+				try:
+					response = openDownload(policy, journal, position, segment[1], journal.get('Size'), True)
+				except (urllib2.URLError, IOError, httplib.HTTPException), error:
+					if getattr(error, 'code', None) == 416:
+						changed.set()
+					break
+			try:
+				count = readInto(response, view[:min(len(view), segment[1] - position)])
+
+				if not count:
+					raise IOError("connection closed at byte %d" % position)
+			except (IOError, httplib.HTTPException), error:
+				response.close()
+				response = None
+
+				if policy.failed(error):
+					continue
+				break
+
+			policy.succeeded()
+			chunk = view[:count]
+			file.write(chunk)
+			position += count
+			downloadMonitor.update(targetFilename, count)
+			bandwidthLimiter.consume(count)
+
+			if verifier and not verifier.update(chunk):
+				downloadMonitor.log("\nERROR: chunk at byte %d of %s failed verification ...\n" % (verifier.failed, basename(url)), sys.stderr)
+				position = verifier.failed
+				break
+			#
+			# The journal only ever sees flushed positions.
+			#
+			if (position - segment[2]) >= 8388608:
+				file.flush()
+				segment[2] = position
+				reportProgress()
+
+			if concurrencyController.transfer(count):
+				# Over the limit, make room (and continue here when it's our turn again).
+				response.close()
+				response = None
+				concurrencyController.park()
+
+		file.flush()
+		segment[2] = position
+
+	if response:
+		response.close()
+
+	concurrencyController.release()
+	reportProgress()
+
+
+def downloadSegmented(url, targetFilename, filesize, journal, chunks, digest):
+	#
+	# Returns the download result, or None when the server doesn't do Range requests.
+	#
+	filename = basename(url)
+	segments = journal.get('Segments')
+	response = None
+
+	if not segments:
+		segmentSize = max(filesize / DOWNLOAD_SEGMENTS, 1)
+		#
+		# Segments start on a chunk boundary (when there is a chunklist) and the last segment
+		# takes the remainder (no tiny trailing segment).
+		#
+		boundaries = [chunk[0] for chunk in chunks] if chunks else range(0, filesize, segmentSize)
+		starts = [0]
+
+		for boundary in boundaries:
+			if boundary >= (starts[-1] + segmentSize) and (boundary + segmentSize) <= filesize:
+				starts.append(boundary)
+
+		segments = [[start, end, start] for start, end in zip(starts, starts[1:] + [filesize])]
+		#
+		# The first segment doubles as probe; no 206 means no Range support (single stream).
+		#
+		# Its stream slot goes to the first segment.
+		concurrencyController.acquire()
+		try:
+			response = openDownload(RetryPolicy(url), journal, 0, segments[0][1], filesize, False)
+		except (urllib2.URLError, IOError, httplib.HTTPException):
+			concurrencyController.release()
+			return None
+
+		if response.getcode() != 206:
+			response.close()
+			concurrencyController.release()
+			return None
+
+		journal['Segments'] = segments
+		#
+		# Journal first, then preallocate the target file (segments are written in place). A full size
+		# file without a journal would pass for a complete download.
+		#
+		writeJournal(targetFilename, journal)
+
+		with open(targetFilename, 'wb') as file:
+			preallocateFile(file, filesize)
+	else:
+		downloadMonitor.log("Download of %s resumed (%d bytes left)" % (filename, sum(segment[1] - segment[2] for segment in segments)))
+
+		if chunks and not set(segment[0] for segment in segments).issubset(set(chunk[0] for chunk in chunks)):
+			# Segments of a download that started without the chunklist.
+			chunks = None
+
+	lock = threading.Lock()
+
+	def reportProgress():
+		with lock:
+			journal['Written'] = sum(segment[2] - segment[0] for segment in segments)
+			writeJournal(targetFilename, journal)
+
+	reportProgress()
+	written = startWritten = journal['Written']
+	downloadMonitor.begin(targetFilename, written)
+	digestVerifier = DigestVerifier(targetFilename, segments=segments) if digest else None
+	changed = threading.Event()
+	threads = []
+
+	for segment in segments:
+		if segment[2] < segment[1]:
+			thread = threading.Thread(target=downloadSegment, args=(url, targetFilename, segment, journal, response, reportProgress, chunks, changed))
+			thread.daemon = True
+			thread.start()
+			threads.append(thread)
+			response = None
+
+	for thread in threads:
+		# Join with a timeout, so that Ctrl+C still works.
+		while thread.is_alive():
+			thread.join(1)
+
+	if changed.is_set() and journal['Written'] != filesize:
+		#
+		# The file on the server changed, start over next time. The preallocated file goes too,
+		# or the next run would take it for a complete download (same size, no journal).
+		#
+		if digestVerifier:
+			digestVerifier.abort()
+
+		for changedFile in (targetFilename, targetFilename + ".journal"):
+			if os.path.exists(changedFile):
+				os.remove(changedFile)
+
+		downloadMonitor.log("\nERROR: %s changed on the server, run the script again to download it again ...\n" % filename, sys.stderr)
+		downloadMonitor.finish(targetFilename, 'incomplete', 0)
+		return getDownloadResult(url, targetFilename, filesize, 0, 'incomplete', "File changed on the server", received=max(journal['Written'] - startWritten, 0))
+
+	written = journal['Written']
+
+	if digestVerifier:
+		if written != filesize or not checkDigest(digestVerifier, digest, targetFilename):
+			digestVerifier.abort()
+
+			if written == filesize:
+				return getDownloadResult(url, targetFilename, filesize, 0, 'failed', "Digest mismatch", received=written - startWritten)
+
+	if written != filesize:
+		downloadMonitor.finish(targetFilename, 'incomplete', written)
+		downloadMonitor.log("\nERROR: download of %s incomplete (%d of %d bytes), run the script again to resume ...\n" % (filename, written, filesize), sys.stderr)
+		return getDownloadResult(url, targetFilename, filesize, written, 'incomplete', received=max(written - startWritten, 0))
+
+	os.remove(targetFilename + ".journal")
+	downloadMonitor.finish(targetFilename, 'finished', written)
+	downloadMonitor.log("Download of %s finished (%d segments)" % (filename, len(segments)))
+	return getDownloadResult(url, targetFilename, filesize, written, 'finished', received=written - startWritten, verified=bool(digest or chunks))
+
+
+def getDigest(argumentData):
+	# The catalog Digest (SHA-1) of a package, when there is one.
+	digest = argumentData[3] if len(argumentData) > 3 else None
+
+	if digest and re.match(r'^[0-9a-fA-F]{40}$', digest):
+		return digest.lower()
+
+	return None
+
+
+def getFileDigest(filename):
+	# SHA-1 of a file that is already on disk.
+	hash = hashlib.sha1()
+
+	with open(filename, 'rb') as file:
+		while True:
+			data = file.read(1048576)
+
+			if not data:
+				break
+
+			hash.update(data)
+
+	return hash.hexdigest()
+
+
+def getFileIdentity(filename):
+	# Same inode, size and modification time means the same (unmodified) file, hardlinks included.
+	info = os.stat(filename)
+	return (info.st_dev, info.st_ino, info.st_size, repr(info.st_mtime))
+
+
+def setVerified(filename, digest):
+	#
+	# The file was checked (Digest or chunklist) from start to end. Recorded, so that it never has to
+	# be read again for this: not on the next run, not from the package store and not by copyFiles().
+	#
+	connection = getIndexConnection()
+
+	with connection:
+		connection.execute("INSERT OR REPLACE INTO verified VALUES (?, ?, ?, ?, ?)", getFileIdentity(filename) + (digest,))
+
+
+def isVerified(filename, digest=None):
+	device, inode, size, mtime = getFileIdentity(filename)
+	rows = getIndexConnection().execute("SELECT size, mtime, digest FROM verified WHERE device = ? AND inode = ?", (device, inode)).fetchall()
+	return len(rows) > 0 and rows[0][:2] == (size, mtime) and (digest == None or rows[0][2] == digest)
+
+
+def checkDigest(digestVerifier, digest, targetFilename):
+	#
+	# Compare the SHA-1 with the catalog Digest. A mismatch means that the file is useless (there's
+	# no way to tell where it went wrong), so it's removed (and downloaded again next time).
+	#
+	if digestVerifier.finish() == digest:
+		return True
+
+	downloadMonitor.finish(targetFilename, 'failed', 0)
+	downloadMonitor.log("\nERROR: %s doesn't match the Digest from the catalog, run the script again to download it again ...\n" % basename(targetFilename), sys.stderr)
+
+	for filename in (targetFilename, targetFilename + ".journal"):
+		if os.path.exists(filename):
+			os.remove(filename)
+
+	return False
+
+
+def getDownloadResult(url, targetFilename, filesize, written, status, error=None, received=0, verified=False):
+	#
+	# Status is one of: skipped, finished, incomplete (run again to resume) or failed. Received is
+	# the number of bytes downloaded this time. Verified means checked against the chunklist or the
+	# catalog Digest (not just the size).
+	#
+	return dict(URL=url, File=targetFilename, Size=filesize, Written=written, Status=status, Error=error, Received=received, Verified=verified)
+
+
+def downloadFiles(argumentData):
+	url = argumentData[0]
+	targetFilename = argumentData[1]
+	filesize = argumentData[2]
+	filename = basename(url)
+	journal = readJournal(targetFilename)
+	chunks = getChunks(targetFilename, filesize)
+	digest = getDigest(argumentData)
+	offset = 0
+
+	if os.path.exists(targetFilename):
+		currentSize = os.path.getsize(targetFilename)
+
+		if journal == None and currentSize == filesize:
+			#
+			# The size alone says nothing (preallocated files have the full size from the start),
+			# so check the chunklist or else the Digest. Unless it was checked before (and didn't change).
+			#
+			if (chunks or digest) and isVerified(targetFilename, digest):
+				downloadMonitor.finish(targetFilename, 'skipped', currentSize)
+				downloadMonitor.log("Download of %s skipped (already complete and verified)" % filename)
+				return getDownloadResult(url, targetFilename, filesize, currentSize, 'skipped', verified=True)
+
+			failed = verifyChunklist(targetFilename, chunks) if chunks else []
+
+			if failed:
+				downloadMonitor.log("Download of %s failed verification (%d bad chunks)" % (filename, len(failed)))
+			elif not chunks and digest and getFileDigest(targetFilename) != digest:
+				# No chunklist to tell us where it went wrong.
+				downloadMonitor.log("Download of %s doesn't match the Digest from the catalog" % filename)
+				failed = [0]
+			else:
+				if chunks or digest:
+					setVerified(targetFilename, digest)
+
+				downloadMonitor.finish(targetFilename, 'skipped', currentSize)
+				downloadMonitor.log("Download of %s skipped (already complete)" % filename)
+				return getDownloadResult(url, targetFilename, filesize, currentSize, 'skipped', verified=bool(chunks or digest))
+			#
+			# Damaged file, download it again from the first bad chunk.
+			#
+			journal = dict(URL=url, Size=filesize, Written=min(failed))
+
+		if journal and journal.get('URL') == url and journal.get('Size') == filesize:
+			if journal.get('Segments'):
+				#
+				# Interrupted segmented download (the file was preallocated).
+				#
+				if currentSize == filesize:
+					return downloadSegmented(url, targetFilename, filesize, journal, chunks, digest)
+			else:
+				#
+				# Interrupted download, continue where the journal says we were (never past the end of the file).
+				#
+				offset = min(journal.get('Written', 0), currentSize)
+
+	if offset == 0:
+		journal = dict(URL=url, Size=filesize, Written=0)
+		#
+		# Large packages are fetched in segments, over multiple connections.
+		#
+		if filesize >= SEGMENTED_DOWNLOAD_SIZE:
+			result = downloadSegmented(url, targetFilename, filesize, journal, chunks, digest)
+
+			if result:
+				return result
+
+		journal = dict(URL=url, Size=filesize, Written=0)
+
+	policy = RetryPolicy(url)
+	concurrencyController.acquire()
+
+	try:
+		fileReq = openDownload(policy, journal, offset, None, filesize, False)
+	except (urllib2.URLError, IOError, httplib.HTTPException), error:
+		concurrencyController.release()
+		downloadMonitor.finish(targetFilename, 'failed', offset)
+		downloadMonitor.log("\nERROR: opening of (%s) failed ...\n" % url, sys.stderr)
+		return getDownloadResult(url, targetFilename, filesize, offset, 'failed', str(error))
+
+	if offset and fileReq.getcode() != 206:
+		# Server ignored the Range request (or the file changed), start over.
+		offset = 0
+
+	journal['Written'] = offset
+	writeJournal(targetFilename, journal)
+	verifier = ChunklistVerifier(chunks, targetFilename, offset) if chunks else None
+
+	startOffset = offset
+
+	with open(targetFilename, 'r+b' if offset else 'wb') as file:
+		if filesize:
+			# Bytes past the offset are simply overwritten.
+			preallocateFile(file, filesize)
+		else:
+			file.seek(offset)
+			file.truncate()
+
+		file.seek(offset)
+		lastJournalUpdate = offset
+		downloadMonitor.begin(targetFilename, offset)
+		digestVerifier = DigestVerifier(targetFilename, offset) if digest else None
+		view = None if digestVerifier else getDownloadBuffer()
+
+		if offset:
+			downloadMonitor.log("Download of %s resumed at byte %d" % (filename, offset))
+
+		while True:
+			if fileReq == None:
+				#
+				# Same offset, same (or the next) source. Only Range responses, we can't start over now.
+				#
+				try:
+					fileReq = openDownload(policy, journal, offset, None, filesize, offset > 0)
+				except (urllib2.URLError, IOError, httplib.HTTPException):
+					break
+
+			if view == None:
+				view = digestVerifier.getBuffer()
+			try:
+				count = readInto(fileReq, view)
+
+				if not count and filesize and offset < filesize:
+					raise IOError("connection closed at byte %d" % offset)
+			except (IOError, httplib.HTTPException), error:
+				# Dropped connection, the journal keeps track of what we have.
+				fileReq.close()
+				fileReq = None
+
+				if policy.failed(error):
+					continue
+				break
+			if not count:
+				break
+			policy.succeeded()
+			chunk = view[:count]
+			file.write(chunk)
+			offset += count
+			downloadMonitor.update(targetFilename, count)
+			bandwidthLimiter.consume(count)
+			#
+			# Check the chunks as they come in, and stop at the first bad one.
+			#
+			if verifier and not verifier.update(chunk):
+				downloadMonitor.log("\nERROR: chunk at byte %d of %s failed verification ...\n" % (verifier.failed, filename), sys.stderr)
+				offset = verifier.failed
+				break
+
+			if digestVerifier:
+				digestVerifier.update(chunk, view)
+				view = None
+			#
+			# Journal update every 8 MB (after the data itself is flushed).
+			#
+			if (offset - lastJournalUpdate) >= 8388608:
+				file.flush()
+				journal['Written'] = offset
+				writeJournal(targetFilename, journal)
+				lastJournalUpdate = offset
+
+			if concurrencyController.transfer(count):
+				# Over the limit, make room (and continue at this offset when it's our turn again).
+				fileReq.close()
+				fileReq = None
+				concurrencyController.park()
+
+	if fileReq:
+		fileReq.close()
+
+	concurrencyController.release()
+
+	if digestVerifier:
+		if (filesize and offset != filesize) or not checkDigest(digestVerifier, digest, targetFilename):
+			digestVerifier.abort()
+
+			if offset == filesize:
+				return getDownloadResult(url, targetFilename, filesize, 0, 'failed', "Digest mismatch", received=offset - startOffset)
+
+	if filesize and offset != filesize:
+		journal['Written'] = offset
+		writeJournal(targetFilename, journal)
+		downloadMonitor.finish(targetFilename, 'incomplete', offset)
+		downloadMonitor.log("\nERROR: download of %s incomplete (%d of %d bytes), run the script again to resume ...\n" % (filename, offset, filesize), sys.stderr)
+		return getDownloadResult(url, targetFilename, filesize, offset, 'incomplete', received=max(offset - startOffset, 0))
+
+	os.remove(targetFilename + ".journal")
+	downloadMonitor.finish(targetFilename, 'finished', offset)
+	downloadMonitor.log("Download of %s finished" % filename)
+	return getDownloadResult(url, targetFilename, filesize, offset, 'finished', received=offset - startOffset, verified=bool(digestVerifier or verifier))
+
+
+def getStoreFilename(argumentData):
+	#
+	# tmp/.packages/<Digest (or SHA-1 of the URL)>-<filename>, on the same volume as tmp/<key>/ (hardlinks).
+	#
+	url = argumentData[0]
+	digest = argumentData[3] if len(argumentData) > 3 and argumentData[3] else hashlib.sha1(url).hexdigest()
+	storePath = os.path.join(os.path.dirname(os.path.dirname(argumentData[1])), storeDirectory)
+	return os.path.join(storePath, "%s-%s" % (digest, basename(url)))
+
+
+def linkFile(sourceFile, targetFile):
+	#
+	# Hardlink, or a clone (APFS) when a hardlink isn't possible. Never a copy (that costs disk space).
+	#
+	try:
+		os.link(sourceFile, targetFile)
+		return True
+	except OSError:
+		pass
+
+	if sys.platform == 'darwin':
+		try:
+			import ctypes
+			import ctypes.util
+			libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+			return libc.clonefile(sourceFile, targetFile, 0) == 0
+		except (OSError, AttributeError):
+			pass
+
+	return False
+
+
+def verifyStoreFile(storeFilename, targetFilename, filesize, digest):
+	#
+	# A package store file is only as good as its check: the chunklist (next to the target file)
+	# or else the catalog Digest. The size alone doesn't count. Files are recorded as verified when
+	# they enter the store, so this normally reads nothing but the record.
+	#
+	if isVerified(storeFilename, digest):
+		return True
+
+	chunks = getChunks(targetFilename, filesize)
+
+	if chunks:
+		verified = not verifyChunklist(storeFilename, chunks)
+	elif digest:
+		verified = getFileDigest(storeFilename) == digest
+	else:
+		return False
+
+	if verified:
+		setVerified(storeFilename, digest)
+
+	return verified
+
+
+def downloadPackage(argumentData):
+	#
+	# Packages that we already have (for any product key or seed program) are linked from the
+	# package store (no download, no extra disk space). Verified downloads are added to the store.
+	#
+	url = argumentData[0]
+	targetFilename = argumentData[1]
+	filesize = argumentData[2]
+	storeFilename = getStoreFilename(argumentData)
+
+	if filesize and os.path.exists(storeFilename) and os.path.getsize(storeFilename) == filesize:
+		linked = os.path.exists(targetFilename) and os.path.samefile(storeFilename, targetFilename)
+
+		if not verifyStoreFile(storeFilename, targetFilename, filesize, getDigest(argumentData)):
+			#
+			# Damaged store file, drop it (and our link to it) so that nobody gets it again.
+			#
+			downloadMonitor.log("Package store copy of %s failed verification (removed)" % basename(url))
 
-	if seedProgram == None:
-		print "\nERROR: No .SeedEnrollment.plist found. Initialising ..."
-		enrollInSeedProgram(targetVolume, targetProductVersion)
-		seedProgram, targetProductVersion = getSeedProgram(targetVolume)
+			for filename in [storeFilename] + ([targetFilename, targetFilename + ".journal"] if linked else []):
+				if os.path.exists(filename):
+					os.remove(filename)
+		#
+		# Unless there's a complete file of our own (checked by downloadFiles).
+		#
+		elif linked or not os.path.exists(targetFilename) or readJournal(targetFilename) != None or os.path.getsize(targetFilename) != filesize:
+			if not linked:
+				for filename in (targetFilename, targetFilename + ".journal"):
+					if os.path.exists(filename):
+						os.remove(filename)
 
-	catalog = seedProgramData.get(seedProgram, seedProgramData['Regular'])
-	catalogURL = "https://swscan.apple.com/content/catalogs/others/" + catalog
-	try:
-		catalogReq = urllib2.urlopen(catalogURL)
-	except URLError:
-		print >> sys.stderr, ("\nERROR: opening of (%s) failed. Aborting ...\n" % url)
-		sys.exit(-1)
+			if linked or linkFile(storeFilename, targetFilename):
+				downloadMonitor.finish(targetFilename, 'skipped', filesize)
+				downloadMonitor.log("Download of %s skipped (found in the package store)" % basename(url))
+				return getDownloadResult(url, targetFilename, filesize, filesize, 'skipped', verified=True)
 
-	return catalogReq.read()
+	result = downloadFiles(argumentData)
 
+	if result['Status'] == 'finished' and result['Verified']:
+		setVerified(targetFilename, getDigest(argumentData))
 
-def getProduct(productType, macOSVersion, targetVolume, targetPackageName):
-	packageData = []
-	catalogData = getCatalogData(targetVolume)
-	root = plistlib.readPlistFromString(catalogData)
-	products = root['Products']
-	if targetPackageName == "*":
-		print "Searching for macOS: %s" % macOSVersion
-	else:
-		print "Searching for: %s for macOS %s" % (targetPackageName, macOSVersion)
+	if result['Status'] in ('finished', 'skipped') and result['Verified'] and not os.path.exists(storeFilename):
+		try:
+			os.makedirs(os.path.dirname(storeFilename))
+		except OSError:
+			if not os.path.isdir(os.path.dirname(storeFilename)):
+				raise
 
-	if productType == "install":
-		for key in products:
-			if 'ExtendedMetaInfo' in products[key]:
-				extendedMetaInfo = products[key]['ExtendedMetaInfo']
+		linkFile(targetFilename, storeFilename)
 
-				if 'InstallAssistantPackageIdentifiers' in extendedMetaInfo:
-					IAPackageIDs = extendedMetaInfo['InstallAssistantPackageIdentifiers']
+	return result
 
-					if IAPackageIDs['InstallInfo'] == 'com.apple.plist.InstallInfo' and IAPackageIDs['OSInstall'] == 'com.apple.mpkg.OSInstall':
-						packageData.extend([key, products[key]])
-	elif productType == "update":
-		for key in products:
-			if 'ExtendedMetaInfo' in products[key]:
-				extendedMetaInfo = products[key]['ExtendedMetaInfo']
-				if 'ProductType' in extendedMetaInfo:
-					if extendedMetaInfo['ProductType'] == 'macOS' and extendedMetaInfo['ProductVersion'] == macOSVersion:
-						packageData.extend([key, products[key]])
 
-	return packageData
+def downloadPackages(metadata, payloads):
+	#
+	# Download threads (no forked processes) that share the connection pool. Metadata first, then
+	# the payloads, one file at a time per thread (no upfront split like map) so that the threads
+	# that are done with the small files pick up the next largest one. How many of them (and their
+	# segments) download at the same time is up to the concurrency controller.
+	#
+	from multiprocessing.pool import ThreadPool
+	startTime = time.time()
+	cpuTime = sum(os.times()[:2])
+	downloadMonitor.start(metadata + payloads, TELEMETRY_FILE)
+	concurrencyController.start(STREAMS_MIN, STREAMS_MAX, DOWNLOAD_THREADS)
+	p = ThreadPool(STREAMS_MAX)
+	results = p.map(downloadPackage, metadata, 1)
+	results += p.map(downloadPackage, payloads, 1)
+	p.close()
+	concurrencyController.stop()
+	downloadMonitor.stop()
+	#
+	# CPU time (user + system, all threads) per GB, to compare buffer sizes and other tuning.
+	#
+	received = sum(result['Received'] for result in results)
 
+	if received >= 67108864:
+		seconds = max(time.time() - startTime, 0.001)
+		print "\nDownloaded %.1f MB in %.1f seconds (%.1f MB/s), CPU time: %.2f seconds per GB" % (received / 1048576.0, seconds, received / 1048576.0 / seconds, (sum(os.times()[:2]) - cpuTime) * 1073741824.0 / received)
 
-def downloadFiles(argumentData):
-	url = argumentData[0]
-	targetFilename = argumentData[1]
-	try:
-		fileReq = urllib2.urlopen(url)
-	except:
-		print >> sys.stderr, ("\nERROR: opening of (%s) failed. Aborting ...\n" % url)
-		sys.exit(-1)
+	return results
 
-	filename = basename(url)
-	filesize = argumentData[2]
 
-	with open(targetFilename, 'wb') as file:
-		while True:
-			chunk = fileReq.read(4096)
-			if not chunk:
-				print "Download of %s finished" % filename
-				break
-			file.write(chunk)
+class DistributionReader(object):
+	#
+	# Single pass (expat) reader for the things we need from a distribution file: BUILD and VERSION
+	# from <auxinfo>, the first localization string (beta check) and the ids of the <pkg-ref> elements.
+	# Parsing stops as soon as <auxinfo> and the first localization string have been read.
+	#
+	def __init__(self):
+		self.info = dict(auxinfo=False, build=0, version=0, beta=False, pkgRefs=[])
+		self.path = []
+		self.data = []
+		self.lastKey = None
+		self.stringsFound = False
+		self.parser = expat.ParserCreate()
+		self.parser.buffer_text = True
+		self.parser.StartElementHandler = self.startElement
+		self.parser.EndElementHandler = self.endElement
+		self.parser.CharacterDataHandler = self.data.append
+
+	def read(self, file):
+		try:
+			self.parser.ParseFile(file)
+		except StopIteration:
+			pass
+		return self.info
+
+	def startElement(self, tag, attributes):
+		self.path.append(tag)
+		del self.data[:]
+		# <pkg-ref> elements of the root element only (like root.findall('pkg-ref')).
+		if tag == 'pkg-ref' and len(self.path) == 2 and 'id' in attributes:
+			self.info['pkgRefs'].append(str(attributes['id']))
+
+	def endElement(self, tag):
+		text = ''.join(self.data).strip()
+		del self.data[:]
+		self.path.pop()
+
+		if 'auxinfo' in self.path:
+			if tag == 'key':
+				self.lastKey = text
+				return
+			elif self.lastKey == 'BUILD':
+				self.info['build'] = str(text)
+			elif self.lastKey == 'VERSION':
+				self.info['version'] = str(text)
+			self.lastKey = None
+		elif tag == 'auxinfo':
+			self.info['auxinfo'] = True
+		elif tag == 'strings' and 'localization' in self.path and not self.stringsFound:
+			self.stringsFound = True
+			self.info['beta'] = 'beta' in text.split(';')[0].lower()
+
+		if self.info['auxinfo'] and self.stringsFound:
+			raise StopIteration
+
+
+def getDistributionInfo(distributionFile, url=None):
+	with open(distributionFile, 'rb') as file:
+		data = file.read()
+	#
+	# Memoized per distribution URL and content hash, so a known file never needs to be parsed again.
+	#
+	url = url or basename(distributionFile)
+	digest = hashlib.sha1(data).hexdigest()
+	connection = getIndexConnection()
+	rows = connection.execute("SELECT info FROM distributions WHERE URL = ? AND digest = ?", (url, digest)).fetchall()
 
+	if rows:
+		return json.loads(rows[0][0])
 
-def isBetaSeed(distributionFile):
-	tree = ElementTree.parse(distributionFile)
-	root = tree.getroot()
-	localization = root.find('localization')
+	info = DistributionReader().read(StringIO(data))
 
-	if not localization == None:
-		localization_iter = localization.iter()
-	
-		for element in localization_iter:
-			if element.tag == 'strings':
-				strings = element.text.split(';')[0]
-				break
+	with connection:
+		connection.execute("INSERT OR REPLACE INTO distributions VALUES (?, ?, ?)", (url, digest, json.dumps(info)))
 
-		if 'beta' in strings.lower():
-			return True
+	return info
 
-	return False
 
+def isBetaSeed(distributionFile, url=None):
+	return getDistributionInfo(distributionFile, url)['beta']
 
-def getBuildAndVersion(distributionFile, targetPackageName, unpackFolder):
-	build  = 0
-	version = 0
-	tree = ElementTree.parse(distributionFile)
-	root = tree.getroot()
-	auxinfo = root.find('auxinfo')
 
-	if not auxinfo == None:
-		auxinfo_iter = auxinfo.iter()
+def getBuildAndVersion(distributionFile, targetPackageName, unpackFolder, url=None):
+	info = getDistributionInfo(distributionFile, url)
+	version = info['version']
 
-		for element in auxinfo_iter:
-			if element.tag == 'key' and element.text == 'BUILD':
-				try:
-					build = auxinfo_iter.next().text
-				except StopIteration:
-					pass
-			elif element.tag == 'key' and element.text == 'VERSION':
-				try:
-					version = auxinfo_iter.next().text
-				except StopIteration:
-					pass
-		return (version, build)
+	if info['auxinfo']:
+		return (version, info['build'])
 	else:
-		for element in root.findall('pkg-ref'):
-			id = element.get('id')
+		for id in info['pkgRefs']:
 			parts = id.split('.')
 
 			if targetPackageName == "FirmwareUpdate.pkg" and unpackFolder != "":
@@ -565,13 +2997,385 @@ def confirmAPFSConversion(targetVolume):
 	return 'NO'
 
 
-def expandPackage(packageName, targetFolder):
+class CpioWriter(object):
+	#
+	# Unpacks a cpio archive into a folder while the data comes in, no cpio command (any platform).
+	# Both formats that pkgbuild and friends write: odc (070707, octal fields) and newc (070701 or
+	# 070702, hex fields, 4 byte aligned). Files, folders, symlinks and hardlinks, with their modes.
+	# Folder modes are set last (a read-only folder can still be filled).
+	#
+	def __init__(self, targetFolder):
+		self.targetFolder = targetFolder
+		self.buffer = ''
+		self.entry = None
+		self.directories = []
+		self.inodes = {}
+		self.links = {}
+		self.done = False
+
+	def write(self, data):
+		self.buffer += data
+
+		while self.buffer and not self.done:
+			if not (self.writeData() if self.entry else self.readHeader()):
+				break
+
+	def readHeader(self):
+		# Returns False when more data is needed.
+		magic = self.buffer[:6]
+
+		if magic == '070707':
+			size = 76
+		elif magic in ('070701', '070702'):
+			size = 110
+		elif len(self.buffer) < 6:
+			return False
+		else:
+			raise ValueError("not a cpio archive (odc or newc)")
+
+		if len(self.buffer) < size:
+			return False
+
+		header = self.buffer[:size]
+
+		if size == 76:
+			# dev, ino, mode, uid, gid, nlink, rdev, mtime (11), namesize and filesize (11), octal.
+			key = (int(header[6:12], 8), int(header[12:18], 8))
+			mode, nlink = int(header[18:24], 8), int(header[36:42], 8)
+			nameSize, fileSize = int(header[59:65], 8), int(header[65:76], 8)
+			namePadding = dataPadding = 0
+		else:
+			# ino, mode, uid, gid, nlink, mtime, filesize, devmajor, devminor, rdevmajor, rdevminor, namesize and check, hex.
+			fields = [int(header[index:index + 8], 16) for index in range(6, 110, 8)]
+			key = (fields[7], fields[8], fields[0])
+			mode, nlink, fileSize, nameSize = fields[1], fields[4], fields[6], fields[11]
+			namePadding = -(size + nameSize) % 4
+			dataPadding = -fileSize % 4
+
+		if len(self.buffer) < size + nameSize + namePadding:
+			return False
+
+		name = self.buffer[size:size + nameSize].rstrip('\0')
+		self.buffer = self.buffer[size + nameSize + namePadding:]
+
+		if name == 'TRAILER!!!':
+			self.done = True
+		else:
+			self.begin(name, mode, fileSize, dataPadding, key if nlink > 1 else None)
+
+		return True
+
+	def begin(self, name, mode, fileSize, padding, key):
+		parts = [part for part in name.split('/') if part not in ('', '.')]
+
+		if name.startswith('/') or '..' in parts:
+			raise ValueError("invalid cpio member name %s" % name)
+
+		target = os.path.join(self.targetFolder, *parts)
+		kind = mode & 0170000
+		self.entry = dict(target=target, mode=mode & 07777, kind=kind, left=fileSize, padding=padding, key=key, file=None, link=[])
+
+		if not parts:
+			# The folder itself (.).
+			self.entry['kind'] = None
+		elif kind == 0040000:
+			if not os.path.isdir(target):
+				os.makedirs(target)
+			self.directories.append((target, mode & 07777))
+		elif kind in (0100000, 0120000):
+			if not os.path.isdir(os.path.dirname(target)):
+				os.makedirs(os.path.dirname(target))
+
+			if kind == 0100000:
+				if key and fileSize == 0 and key in self.inodes:
+					# Hardlink to a file that we already have.
+					os.link(self.inodes[key], target)
+					self.entry['kind'] = None
+				else:
+					self.entry['file'] = open(target, 'wb')
+
+					if key and fileSize == 0:
+						# newc: the data comes with the last link.
+						self.links.setdefault(key, []).append(target)
+		else:
+			# Devices, fifos and sockets are skipped (not in packages).
+			self.entry['kind'] = None
+
+	def writeData(self):
+		entry = self.entry
+
+		if entry['left']:
+			data = self.buffer[:entry['left']]
+			self.buffer = self.buffer[len(data):]
+			entry['left'] -= len(data)
+
+			if entry['file']:
+				entry['file'].write(data)
+			elif entry['kind'] == 0120000:
+				entry['link'].append(data)
+
+			if entry['left']:
+				return False
+
+		if len(self.buffer) < entry['padding']:
+			return False
+
+		self.buffer = self.buffer[entry['padding']:]
+		self.entry = None
+
+		if entry['kind'] == 0100000:
+			entry['file'].close()
+			os.chmod(entry['target'], entry['mode'])
+
+			if entry['key'] and entry['target'] not in self.links.get(entry['key'], []):
+				self.inodes[entry['key']] = entry['target']
+
+				for target in self.links.pop(entry['key'], []):
+					os.remove(target)
+					os.link(entry['target'], target)
+		elif entry['kind'] == 0120000:
+			os.symlink(''.join(entry['link']), entry['target'])
+
+		return True
+
+	def close(self):
+		if not self.done:
+			if self.entry and self.entry['file']:
+				self.entry['file'].close()
+			raise ValueError("truncated cpio archive")
+
+		for target, mode in reversed(self.directories):
+			os.chmod(target, mode)
+
+
+class XarReader(object):
+	#
+	# Single pass (expat) reader for the TOC of a xar archive (flat packages). Members are listed in
+	# the order of the TOC (directories before their contents), with the location and encoding of
+	# their data in the heap.
+	#
+	def __init__(self):
+		self.members = []
+		self.checksum = {}
+		self.path = []
+		self.files = []
+		self.style = None
+		self.data = []
+		self.parser = expat.ParserCreate()
+		self.parser.buffer_text = True
+		self.parser.StartElementHandler = self.startElement
+		self.parser.EndElementHandler = self.endElement
+		self.parser.CharacterDataHandler = self.data.append
+
+	def read(self, data):
+		self.parser.Parse(data, True)
+
+		for member in self.members:
+			parent = member.pop('parent')
+			member['path'] = member['name'] if parent == None else parent['path'] + '/' + member['name']
+
+		return self.members
+
+	def startElement(self, tag, attributes):
+		parent = self.path[-1] if self.path else None
+		self.path.append(tag)
+		del self.data[:]
+
+		if tag == 'file':
+			member = dict(name=None, type='file', parent=self.files[-1] if self.files else None, offset=0, length=0, size=0, encoding=None,
+				checksum=None, mode=None, link=None)
+			self.files.append(member)
+			self.members.append(member)
+		elif parent == 'data' and tag == 'encoding':
+			self.files[-1]['encoding'] = attributes.get('style')
+		elif parent == 'data' and tag == 'extracted-checksum':
+			self.style = attributes.get('style')
+		elif parent == 'toc' and tag == 'checksum':
+			self.checksum['style'] = attributes.get('style')
+
+	def endElement(self, tag):
+		text = ''.join(self.data).strip()
+		del self.data[:]
+		self.path.pop()
+		parent = self.path[-1] if self.path else None
+
+		if tag == 'file':
+			self.files.pop()
+		elif parent == 'file' and tag in ('name', 'type', 'mode', 'link'):
+			self.files[-1][tag] = text.encode('utf-8')
+		elif parent == 'data' and tag in ('offset', 'length', 'size'):
+			self.files[-1][tag] = int(text)
+		elif parent == 'data' and tag == 'extracted-checksum':
+			self.files[-1]['checksum'] = (self.style, text.lower())
+		elif parent == 'checksum' and len(self.path) == 3 and tag in ('offset', 'size'):
+			self.checksum[tag] = int(text)
+
+
+class XarArchive(object):
+	#
+	# Random access to the members of a xar archive (flat packages), no pkgutil (any platform). The
+	# TOC is read once, after that only the bytes of the members that we extract are read (mmap).
+	#
+	def __init__(self, filename):
+		self.file = open(filename, 'rb')
+		self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+		# Header (big endian): magic, header size, version, TOC size (compressed, uncompressed) and checksum type.
+		magic, headerSize, version, tocSize, tocLength, checksumType = struct.unpack('>4sHHQQI', self.map[:28])
+
+		if magic != 'xar!':
+			self.close()
+			raise ValueError("%s is not a xar archive" % basename(filename))
+
+		self.heap = headerSize + tocSize
+		toc = self.map[headerSize:self.heap]
+		reader = XarReader()
+		self.members = reader.read(zlib.decompress(toc))
+		checksum = reader.checksum
+		#
+		# The checksum of the (compressed) TOC is stored at the start of the heap.
+		#
+		if checksum.get('style') in ('sha1', 'md5', 'sha256', 'sha512') and 'offset' in checksum:
+			start = self.heap + checksum['offset']
+
+			if hashlib.new(checksum['style'], toc).digest() != self.map[start:start + checksum['size']]:
+				self.close()
+				raise ValueError("TOC checksum mismatch in %s" % basename(filename))
+
+	def find(self, name):
+		# Members by path, or by name (all of them, like the Payload of every component package),
+		# with the contents of directories.
+		paths = tuple(member['path'] + '/' for member in self.members if name in (member['path'], member['name']) and member['type'] == 'directory')
+		return [member for member in self.members if name in (member['path'], member['name']) or (paths and member['path'].startswith(paths))]
+
+	def read(self, member):
+		#
+		# The (decoded) data of a member, in blocks. application/x-gzip is zlib in xar archives.
+		#
+		encoding = member['encoding'] or 'application/octet-stream'
+
+		if encoding == 'application/x-gzip':
+			decoder = zlib.decompressobj()
+		elif encoding == 'application/x-bzip2':
+			import bz2
+			decoder = bz2.BZ2Decompressor()
+		elif encoding == 'application/octet-stream':
+			decoder = None
+		else:
+			raise ValueError("%s: unsupported encoding %s" % (member['path'], encoding))
+
+		position = self.heap + member['offset']
+		end = position + member['length']
+
+		while position < end:
+			data = self.map[position:min(position + DOWNLOAD_BUFFER_SIZE, end)]
+			position += len(data)
+			yield decoder.decompress(data) if decoder else data
+
+		if encoding == 'application/x-gzip':
+			yield decoder.flush()
+
+	def extract(self, member, targetFolder):
+		path = member['path']
+
+		if not member['name'] or '..' in path.split('/') or path.startswith('/'):
+			raise ValueError("invalid member name %s" % path)
+
+		target = os.path.join(targetFolder, path)
+
+		if not os.path.isdir(os.path.dirname(target)):
+			os.makedirs(os.path.dirname(target))
+
+		if member['type'] == 'directory':
+			if not os.path.isdir(target):
+				os.mkdir(target)
+		elif member['type'] == 'symlink':
+			os.symlink(member['link'], target)
+			return
+		else:
+			hash = hashlib.new(member['checksum'][0]) if member['checksum'] and member['checksum'][0] in ('sha1', 'md5', 'sha256', 'sha512') else None
+
+			if member['name'] == 'Scripts':
+				self.extractScripts(member, target, hash)
+			else:
+				with open(target, 'wb') as file:
+					for data in self.read(member):
+						file.write(data)
+
+						if hash:
+							hash.update(data)
+
+			if hash and hash.hexdigest() != member['checksum'][1]:
+				raise ValueError("%s: checksum mismatch" % path)
+
+		# The mode of Scripts is that of the archive, not of the folder that it became.
+		if member['mode'] and (member['type'] == 'directory' or not os.path.isdir(target)):
+			os.chmod(target, int(member['mode'], 8))
+
+	def extractScripts(self, member, target, hash):
+		#
+		# Scripts is a (gzip) cpio archive, that pkgutil --expand unpacks into a Scripts folder. So do
+		# we, efiver.py reads the firmware payloads from Scripts/Tools/EFIPayloads.
+		#
+		os.mkdir(target)
+		writer = CpioWriter(target)
+		decoder = None
+
+		for data in self.read(member):
+			if hash:
+				hash.update(data)
+			if not data:
+				continue
+			if decoder == None:
+				# 16 + MAX_WBITS tells zlib to expect (and skip) the gzip header.
+				decoder = zlib.decompressobj(16 + zlib.MAX_WBITS) if data.startswith('\x1f\x8b') else False
+
+			writer.write(decoder.decompress(data) if decoder else data)
+
+		if decoder:
+			writer.write(decoder.flush())
+
+		writer.close()
+
+	def close(self):
+		self.map.close()
+		self.file.close()
+
+
+def expandPackage(packageName, targetFolder, members=None):
 	if os.path.isdir(targetFolder):
 		print "\nError: Given target path already exists!"
 		print "       Please remove it or use a different path!\n\nAborting ...\n"
 		sys.exit(17)
 	print "Expanding %s to %s" %(basename(packageName), targetFolder)
-	subprocess.call(['pkgutil', '--expand', packageName, targetFolder])
+	#
+	# Everything (like pkgutil --expand) or only the given members (-x), think Payload or Scripts.
+	#
+	try:
+		archive = XarArchive(packageName)
+		selected = archive.members
+
+		if members:
+			selected = []
+			paths = set()
+
+			for name in members:
+				for member in archive.find(name):
+					if member['path'] not in paths:
+						paths.add(member['path'])
+						selected.append(member)
+
+			if not selected:
+				print "\nWarning: %s not found in %s!" % (', '.join(members), basename(packageName))
+
+		for member in selected:
+			archive.extract(member, targetFolder)
+
+		archive.close()
+	except (EnvironmentError, ValueError, ExpatError, zlib.error, struct.error), error:
+		print >> sys.stderr, ("\nERROR: expanding %s failed (%s). Aborting ...\n" % (basename(packageName), error))
+		# Half expanded is of no use, and the next run refuses an existing target folder.
+		shutil.rmtree(targetFolder, True)
+		sys.exit(-1)
 	sys.exit(0)
 
 
@@ -588,35 +3392,34 @@ def getPackages(productType, macOSVersion, targetPackageName, targetVolume, unpa
 
 	list = []
 	buildIDs = []
+	productIndexes = []
 	item = 0
 	index = 0
 	indent = ' - '
 	selectorText = ''
 	currentBuildID = getSystemVersionPlist(targetVolume, 'ProductBuildVersion')
 	packageCount = (len(data)/2)
+	distributionFiles = getDistributionFiles(data, targetVolume, languageSelector)
 
 	while(index < (packageCount*2)):
 		key = data[index]
-		product = data[index+1]
+		distributionFile = distributionFiles[index/2]
+		distributionURL = getDistributionURL(data[index+1], languageSelector)
 		index+=2
-		targetPath = os.path.join(targetVolume, tmpDirectory, key)
-
-		if not os.path.isdir(targetPath):
-			os.makedirs(targetPath)
 
-		distributions = product['Distributions']
-
-		if distributions[languageSelector]:
-			distributionURL = distributions.get(languageSelector)
-			distributionFile = downloadDistributionFile(distributionURL, targetPath)
+		if distributionFile == None:
+			continue
 
-		seedVersion, seedBuildID = getBuildAndVersion(distributionFile, targetPackageName, unpackFolder)
+		seedVersion, seedBuildID = getBuildAndVersion(distributionFile, targetPackageName, unpackFolder, distributionURL)
 
 		if productType == 'update' and seedVersion == 0:
 			seedVersion = macOSVersion
 
-		if seedVersion >= macOSVersion:
+		setProductBuild(key, seedVersion, seedBuildID)
+
+		if getVersionKey(seedVersion) >= getVersionKey(macOSVersion):
 			buildIDs.append(seedBuildID)
+			productIndexes.append((index/2)-1)
 		else:
 			continue
 
@@ -630,9 +3433,9 @@ def getPackages(productType, macOSVersion, targetPackageName, targetVolume, unpa
 
 		if currentBuildID == seedBuildID:
 			print "%swarning: seed build version is the same as macOS on this Mac!" % indent
-		elif currentBuildID > seedBuildID:
+		elif getBuildKey(currentBuildID) > getBuildKey(seedBuildID):
 			print "%swarning: seed build version is older than macOS on this Mac!" % indent
-		elif currentBuildID < seedBuildID:
+		else:
 			print "%sseed build version is newer than macOS on this Mac (Ok)" % indent
 
 	if len(buildIDs) == 0:
@@ -643,11 +3446,11 @@ def getPackages(productType, macOSVersion, targetPackageName, targetVolume, unpa
 	print ''
 	while True:
 		if item > 1:
-			selection = raw_input("Select package to install [1-%s] " % packageCount)
+			selection = raw_input("Select package to install [1-%s] " % item)
 
 			if selection.isdigit():
 				number = int(selection)
-				if number > 0 and number <= packageCount:
+				if number > 0 and number <= item:
 					number-=1
 					break
 				else:
@@ -662,16 +3465,19 @@ def getPackages(productType, macOSVersion, targetPackageName, targetVolume, unpa
 
 	if currentBuildID == seedBuildID:
 		confirmationText = "\nAre you sure that you want to continue [y/n] ? "
-	elif currentBuildID > seedBuildID:
+	elif getBuildKey(currentBuildID) > getBuildKey(seedBuildID):
 		confirmationText = "\nAre you absolutely sure that you want to continue [y/n] ? "
-	elif currentBuildID < seedBuildID:
+	else:
 		confirmationText = "\nDo you want to continue [y/n] ? "
 
 	if askForConfirmation == True:
 		confirmWithText(confirmationText, True)
 
-	# update key / use key from the selected item.
+	# update key / use key from the selected item (skipped products are not in the selection list).
+	number = productIndexes[number]
 	key = data[(number*2)]
+	distributionFile = distributionFiles[number]
+	distributionURL = getDistributionURL(data[((number*2)+1)], languageSelector)
 	# update targetPath / use path from the selected item.
 	targetPath = os.path.join(targetVolume, tmpDirectory, key)
 	product = data[((number*2)+1)]
@@ -684,28 +3490,57 @@ def getPackages(productType, macOSVersion, targetPackageName, targetVolume, unpa
 
 		if filename == targetPackageName or targetPackageName == "*":
 			filesize = package.get('Size')
-			args = [url, targetFilename, filesize]
+			args = [url, targetFilename, filesize, package.get('Digest')]
 			list.append(args)
 
 			if not targetPackageName == "*":
 				break;
 
 	if not len(list) == 0:
+		metadata, payloads = scheduleDownloads(list)
 		print "\nQueued Download(s):"
-		for array in list:
+		for array in metadata + payloads:
 			print "%s [%s bytes]" % (basename(array[1]), array[2])
 		print ''
-		p = Pool()
-		p.map(downloadFiles, list)
-		p.close()
+		results = downloadPackages(metadata, payloads)
+		failed = [result for result in results if result['Status'] in ('incomplete', 'failed')]
+
+		if failed:
+			print >> sys.stderr, ("\nERROR: %d download(s) failed:" % len(failed))
+			for result in failed:
+				print >> sys.stderr, ("       - %s (%s)" % (basename(result['File']), result['Error'] or "%s of %s bytes" % (result['Written'], result['Size'])))
+			print >> sys.stderr, ("       run the script again to resume. Aborting ...\n")
+			sys.exit(-1)
 	else:
 		if targetPackageName != "*":
 			print "\nWarning: target package > %s < not found!" % targetPackageName
 
 	if not unpackFolder == '':
-		expandPackage(targetFilename, unpackFolder)
+		expandPackage(targetFilename, unpackFolder, UNPACK_MEMBERS)
 	
-	return (key, distributionFile, targetVolume)
+	return (key, distributionFile, distributionURL, targetVolume)
+
+
+def scheduleDownloads(downloads):
+	#
+	# Split the downloads in small metadata files (chunklists, InstallInfo.plist, OSInstall.mpkg
+	# and the like) smallest first, and payloads largest first (Size from the catalog). Handing the
+	# payloads out largest first balances the bytes over the workers, and the largest download
+	# (which decides the total time) starts right away. Unknown sizes go last.
+	#
+	metadata = []
+	payloads = []
+
+	for args in downloads:
+		if args[1].endswith(".chunklist") or (args[2] and args[2] < METADATA_SIZE):
+			metadata.append(args)
+		else:
+			payloads.append(args)
+
+	metadata.sort(key=lambda args: args[2])
+	payloads.sort(key=lambda args: args[2] or 0, reverse=True)
+	payloads.sort(key=lambda args: not args[2])
+	return (metadata, payloads)
 
 
 def getDiskInfoByVolume(targetVolume):
@@ -740,6 +3575,22 @@ def getDiskInfoByVolume(targetVolume):
 	return (isSolidState, partitionType)
 
 
+def checkChunklist(filename):
+	chunks = readChunklist(getChunklistFilename(filename))
+
+	if chunks and os.path.exists(filename):
+		if isVerified(filename) and (chunks[-1][0] + chunks[-1][1]) == os.path.getsize(filename):
+			# Checked when it was downloaded (or found in the package store), and not changed since.
+			return
+
+		print "Verifying: %s ..." % basename(filename)
+		failed = verifyChunklist(filename, chunks)
+
+		if failed or (chunks[-1][0] + chunks[-1][1]) != os.path.getsize(filename):
+			print >> sys.stderr, ("\nERROR: %s failed verification (%d bad chunks), run the script again to repair it. Aborting ...\n" % (filename, len(failed)))
+			sys.exit(-1)
+
+
 def copyFiles(distributionFile, key, targetVolume, applicationPath):
 	sourcePath = os.path.join(targetVolume, tmpDirectory, key)
 	sharedSupportPath = os.path.join(applicationPath, "Contents/SharedSupport")
@@ -750,6 +3601,12 @@ def copyFiles(distributionFile, key, targetVolume, applicationPath):
 		#
 		if not os.path.exists(sharedSupportPath + "/AppleDiagnostics.dmg"):
 			#
+			# Don't copy damaged disk images.
+			#
+			print ''
+			for filename in ("InstallESDDmg.pkg", "AppleDiagnostics.dmg", "BaseSystem.dmg"):
+				checkChunklist(os.path.join(sourcePath, filename))
+			#
 			# Without this step we end up with installer.pkg as InstallDMG.dmg and InstallInfo.plist
 			#
 			print "\nCopying: InstallESDDmg.pkg to the target location ..."
@@ -783,6 +3640,8 @@ def runInstaller(installerPkg, targetVolume):
 def installPackage(distributionFile, key, targetVolume):
 	targetPath = os.path.join(targetVolume, tmpDirectory, key)
 	installerPkg = os.path.join(targetPath, installerPackage)
+	# Set here (inherited by productbuild and installer), not on import.
+	os.environ['__OS_INSTALL'] = "1"
 	print "\nCreating installer.pkg ..."
 	subprocess.call(['sudo', 'productbuild', '--distribution', distributionFile, '--package-path', targetPath, installerPkg])
 
@@ -791,6 +3650,7 @@ def installPackage(distributionFile, key, targetVolume):
 
 
 def getActiveCSRConfig():
+	from ctypes import CDLL, c_uint, byref
 	libSystem = CDLL('/usr/lib/system/libsystem_kernel.dylib')
 	i = c_uint(0)
 	if libSystem.csr_get_active_config(byref(i)) == 0:
@@ -828,6 +3688,8 @@ def launchGUIInstall(applicationPath):
 
 
 def startOSInstall(targetVolume, applicationPath, macOSVersion):
+	os.environ['__OS_INSTALL'] = "1"
+
 	if macOSVersion >= 10.11 and macOSVersion < 10.12:
 		launchStartOSInstall(targetVolume, applicationPath)
 	elif macOSVersion >= 10.12:
@@ -842,6 +3704,329 @@ def startOSInstall(targetVolume, applicationPath, macOSVersion):
 		launchGUIInstall(applicationPath)
 
 
+class MirrorFile(object):
+	#
+	# One upstream transfer per file. The first request starts a thread that fills the mirror cache,
+	# every request (including the first one) reads from the growing .part file while it arrives.
+	#
+	lock = threading.Lock()
+	transfers = {}
+
+	def __init__(self, url, cacheFile):
+		self.url = url
+		self.cacheFile = cacheFile
+		self.length = None
+		self.written = 0
+		self.error = None
+		self.done = False
+		self.condition = threading.Condition()
+
+	@classmethod
+	def get(cls, url, cacheFile):
+		with cls.lock:
+			if os.path.exists(cacheFile):
+				return None
+			if cacheFile not in cls.transfers:
+				mirrorFile = cls(url, cacheFile)
+				cls.transfers[cacheFile] = mirrorFile
+				thread = threading.Thread(target=mirrorFile.fill)
+				thread.daemon = True
+				thread.start()
+			return cls.transfers[cacheFile]
+
+	def fill(self):
+		#
+		# Through openDownload(): retries with backoff, failover (-F) and the 60 second socket timeout
+		# of the connection pool. A dropped connection continues (Range) from what we already have.
+		#
+		partFile = self.cacheFile + ".part"
+		policy = RetryPolicy(self.url)
+		journal = dict(URL=self.url)
+		response = None
+
+		try:
+			try:
+				os.makedirs(os.path.dirname(partFile))
+			except OSError:
+				# Already there (or created by another transfer).
+				if not os.path.isdir(os.path.dirname(partFile)):
+					raise
+
+			response = openDownload(policy, journal, 0, None, None, False)
+			length = response.info().getheader('Content-Length')
+
+			with open(partFile, 'wb') as file:
+				with self.condition:
+					self.length = int(length) if length else -1
+					self.condition.notifyAll()
+
+				while True:
+					if response == None:
+						response = openDownload(policy, journal, self.written, None, max(self.length, 0), True)
+					try:
+						chunk = response.read(262144)
+
+						if not chunk and self.written < self.length:
+							raise IOError("connection closed at byte %d" % self.written)
+					except (IOError, httplib.HTTPException), error:
+						response.close()
+						response = None
+
+						if policy.failed(error):
+							continue
+						raise
+
+					if not chunk:
+						break
+
+					policy.succeeded()
+					file.write(chunk)
+					file.flush()
+
+					with self.condition:
+						self.written += len(chunk)
+						self.condition.notifyAll()
+
+			os.rename(partFile, self.cacheFile)
+		except (urllib2.URLError, IOError, OSError, httplib.HTTPException), error:
+			self.error = getattr(error, 'code', 502)
+
+		if response:
+			response.close()
+
+		with MirrorFile.lock:
+			del MirrorFile.transfers[self.cacheFile]
+
+		with self.condition:
+			self.done = True
+			self.condition.notifyAll()
+
+	def waitForHeaders(self):
+		with self.condition:
+			while self.length == None and not self.done:
+				self.condition.wait()
+		return self.length
+
+	def waitForData(self, offset):
+		with self.condition:
+			while self.written <= offset and not self.done:
+				self.condition.wait()
+			return self.written
+
+
+class MirrorRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+	#
+	# URL layout: http://<mirror>/<scheme>/<host>/<path>, think:
+	# http://mirror:8088/https/swscan.apple.com/content/catalogs/others/index-10.13seed-(...).sucatalog
+	#
+	protocol_version = "HTTP/1.1"
+
+	def do_HEAD(self):
+		self.do_GET()
+
+	def do_GET(self):
+		parts = self.path.split('?')[0].lstrip('/').split('/', 2)
+
+		if len(parts) < 3 or parts[0] not in ('http', 'https') or '..' in parts[2].split('/'):
+			self.send_error(404)
+			return
+
+		scheme, host, path = parts
+		url = "%s://%s/%s" % (scheme, host, path)
+
+		if not self.isUpstreamHost(host):
+			# Not an open proxy.
+			self.send_error(403)
+			return
+
+		if path.endswith(".sucatalog") or path.endswith(".sucatalog.gz"):
+			self.sendCatalog(url)
+		else:
+			self.sendFile(url, os.path.join(MIRROR_DIRECTORY, scheme, host, path))
+
+	def isUpstreamHost(self, host):
+		#
+		# Apple's hosts (swscan, swdist, swcdn and the like) and those of the catalog (-r) or mirrors (-F).
+		#
+		host = host.lower()
+		hosts = MIRROR_HOSTS + [urlparse.urlsplit(url).netloc.lower() for url in [SUCATALOG_URL] + MIRROR_URLS]
+
+		for name in hosts:
+			if host == name or host.endswith('.' + name):
+				return True
+
+		return False
+
+	def getMirrorURL(self):
+		return "http://%s" % (self.headers.getheader('Host') or "%s:%d" % self.server.server_address)
+
+	def sendCatalog(self, url):
+		isCompressed = url.endswith(".gz")
+		catalogURL = url[:-3] if isCompressed else url
+
+		try:
+			catalogStream, modified = fetchCatalog(catalogURL)
+		except SystemExit:
+			# No catalog (and no cached copy), fetchCatalog() gave up. That ends the request, not the thread.
+			self.send_error(502)
+			return
+		cacheInfo = catalogStream.cacheInfo or {}
+		mirrorURL = self.getMirrorURL()
+		etag = '"%s"' % hashlib.sha1("%s%s%s%s" % (cacheInfo.get('ETag'), cacheInfo.get('Last-Modified'), mirrorURL, isCompressed)).hexdigest()
+
+		if self.headers.getheader('If-None-Match') == etag:
+			catalogStream.close()
+			self.send_response(304)
+			self.send_header('ETag', etag)
+			self.send_header('Content-Length', '0')
+			self.end_headers()
+			return
+
+		self.send_response(200)
+		self.send_header('Content-Type', 'application/octet-stream')
+		self.send_header('ETag', etag)
+		self.send_header('Connection', 'close')
+		self.end_headers()
+		self.close_connection = True
+
+		if self.command == 'HEAD':
+			catalogStream.close()
+			return
+		#
+		# Point every URL in the catalog at the mirror, line by line (one plist value per line).
+		#
+		compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS) if isCompressed else None
+		pattern = re.compile(r'<string>(https?)://([^/<\s]+)/')
+		replacement = '<string>' + mirrorURL.replace('\\', '\\\\') + r'/\1/\2/'
+		remainder = ''
+
+		while True:
+			chunk = catalogStream.read(65536)
+			data = remainder + chunk
+
+			if chunk:
+				data, newline, remainder = data.rpartition('\n')
+				data += newline
+
+			data = pattern.sub(replacement, data)
+
+			if compressor:
+				data = compressor.compress(data) + ('' if chunk else compressor.flush())
+
+			self.wfile.write(data)
+
+			if not chunk:
+				break
+
+		catalogStream.close()
+
+	def getRange(self, length):
+		# Single range only (bytes=start-end, bytes=start- or bytes=-suffix).
+		match = re.match(r'^bytes=(\d*)-(\d*)$', self.headers.getheader('Range') or '')
+
+		if not match or length < 0 or (match.group(1) == '' and match.group(2) == ''):
+			return None
+		elif match.group(1) == '':
+			return (max(0, length - int(match.group(2))), length - 1)
+
+		return (int(match.group(1)), min(int(match.group(2) or length - 1), length - 1))
+
+	def sendFile(self, url, cacheFile):
+		mirrorFile = MirrorFile.get(url, cacheFile)
+
+		if mirrorFile:
+			length = mirrorFile.waitForHeaders()
+
+			if mirrorFile.error:
+				self.send_error(mirrorFile.error if mirrorFile.error in (403, 404) else 502)
+				return
+		else:
+			length = os.path.getsize(cacheFile)
+
+		byteRange = self.getRange(length)
+
+		if byteRange:
+			start, end = byteRange
+
+			if start > end:
+				self.send_response(416)
+				self.send_header('Content-Range', 'bytes */%d' % length)
+				self.send_header('Content-Length', '0')
+				self.end_headers()
+				return
+
+			self.send_response(206)
+			self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, end, length))
+		else:
+			start, end = (0, length - 1)
+			self.send_response(200)
+
+		self.send_header('Content-Type', 'application/octet-stream')
+		self.send_header('Accept-Ranges', 'bytes')
+
+		if length < 0:
+			# Unknown length (no Content-Length from upstream).
+			end = sys.maxint
+			self.send_header('Connection', 'close')
+			self.close_connection = True
+		else:
+			self.send_header('Content-Length', str(end - start + 1))
+
+		self.end_headers()
+
+		if self.command == 'HEAD':
+			return
+
+		try:
+			file = open(cacheFile + ".part" if mirrorFile else cacheFile, 'rb')
+		except IOError:
+			# Transfer completed (and renamed) in the meantime.
+			file = open(cacheFile, 'rb')
+
+		with file:
+			offset = start
+			file.seek(offset)
+
+			while offset <= end:
+				if mirrorFile:
+					available = mirrorFile.waitForData(offset)
+
+					if available <= offset:
+						# Upstream transfer ended (or failed) before this offset.
+						self.close_connection = True
+						return
+				else:
+					available = end + 1
+
+				chunk = file.read(min(262144, available - offset, end - offset + 1))
+
+				if not chunk:
+					return
+
+				self.wfile.write(chunk)
+				offset += len(chunk)
+
+
+class MirrorServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+	daemon_threads = True
+	allow_reuse_address = True
+
+
+def startMirror(port):
+	server = MirrorServer(('', port), MirrorRequestHandler)
+	print "Mirror: serving %s on port %d (catalog: http://<this host>:%d/https/%s<catalog>) ..." % (MIRROR_DIRECTORY, port, port, SUCATALOG_URL.split('://')[1])
+	server.serve_forever()
+
+
+def getMirroredURL(mirrorURL, url):
+	scheme, path = url.split('://', 1)
+	return "%s/%s/%s" % (mirrorURL.rstrip('/'), scheme, path)
+
+
+def getMirrorCatalogURL(mirrorURL):
+	return getMirroredURL(mirrorURL, SUCATALOG_URL)
+
+
 def showUsage(error, arg):
 	if  error == True and not arg == '':
 		print "Error: invalid argument '%s' used\n" % arg
@@ -852,6 +4037,7 @@ def showUsage(error, arg):
 	print "installSeed.py -a update -f <packagename>"
 	print "installSeed.py -a update -f <packagename> -t <volume>"
 	print "installSeed.py -a update -f <packagename> -t <volume> -u [target path]"
+	print "installSeed.py -a update -f <packagename> -t <volume> -u [target path] -x <member> (expand only Payload, Scripts or the like)"
 	print "installSeed.py -a update -f <packagename> -t <volume> -c [0/1] (0 skips confirmation)\n"
 	print "installSeed.py -a update -f <packagename> -t <volume> -c [0/1] (0 skips confirmation) -m [10.13.x]\n"
 	print "installSeed.py -a install"
@@ -860,26 +4046,45 @@ def showUsage(error, arg):
 	print "installSeed.py -a install -f <packagename> -t <volume> -u [target path]"
 	print "installSeed.py -a install -f <packagename> -t <volume> -c [0/1] (0 skips confirmation)\n"
 	print "installSeed.py -a install -f <packagename> -t <volume> -c [0/1] (0 skips confirmation) -m [10.13.x]\n"
+	print "installSeed.py -s (show the newest build of each seed program)"
+	print "installSeed.py -d (show the catalog changes since the last run as JSON lines)"
+	print "installSeed.py -d -p <program/all>"
+	print "installSeed.py -j -a <update/install> -p <program/all> -m [10.13.x] -f <packagename> (matching products as JSON lines)\n"
+	print "installSeed.py -M <port> (run a caching mirror for catalogs, distribution files and packages)"
+	print "installSeed.py -r http://<mirror>:<port> -a install (use the mirror, works with all other arguments)"
+	print "installSeed.py -F http://<mirror>:<port> -a install (another mirror to try before Apple, can be used more than once)\n"
+	print "installSeed.py -b <KB> -a install (download buffer size, works with all other arguments)"
+	print "installSeed.py -T <file[.prom]> -a install (download telemetry as JSON lines or for Prometheus, works with all other arguments)"
+	print "installSeed.py -g <bytes/s[K/M/G]>[@HH:MM-HH:MM] -a install (bandwidth limit and low CPU/disk priority, 0 for no limit)"
+	print "installSeed.py -S <min>[-<max>] -a install (number of download streams, adjusted to the throughput within these limits)\n"
 	sys.exit(2)
 
 
-def main(argv):
+def showCopyright():
 	sys.stdout.write("\x1b[2J\x1b[H")
 	YEAR = datetime.now().year
 	print "----------------------------------------------------------------"
 	print "installSeed.py v%s Copyright (c) 2017-%s by Dr. Pike R. Alpha" % (VERSION, YEAR)
 	print "----------------------------------------------------------------"
+
+
+def main(argv):
+	global SUCATALOG_URL, DOWNLOAD_BUFFER_SIZE, TELEMETRY_FILE, STREAMS_MIN, STREAMS_MAX
 	action = 'install'
 	target = '*'
 	volume = ''
 	confirm = True;
 	unpackFolder = ''
-	macOSVersion = getOSVersion()
-	languageSelector = selectLanguage(macOSVersion)
 	targetOSVersion = '10.13.3'
+	survey = False
+	diff = False
+	query = False
+	seedProgram = ''
+	versionFilter = ''
+	mirrorPort = 0
 
 	try:
-		opts, args = getopt.getopt(argv,"h:a:f:t:c:u:m:",["help","action","file","target","confirmation","unpack","mac"])
+		opts, args = getopt.getopt(argv,"h:a:f:t:c:u:x:m:sdjp:M:r:F:b:T:g:S:",["help","action","file","target","confirmation","unpack","member","mac","survey","diff","json","program","mirror","relay","failover","buffer","telemetry","governor","streams"])
 	except getopt.GetoptError as error:
 		print str(error)
 		showUsage(True, '')
@@ -903,19 +4108,111 @@ def main(argv):
 				unpackFolder = arg
 			else:
 				showUsage(True, arg)
+		elif opt in ('-x', '--member'):
+			# Expand (-u) only this member (name or path) of the package, can be used more than once.
+			UNPACK_MEMBERS.append(arg)
 		elif opt == '-m':
 			targetOSVersion = arg
+			versionFilter = arg
+		elif opt in ('-s', '--survey'):
+			survey = True
+		elif opt in ('-d', '--diff'):
+			diff = True
+		elif opt in ('-j', '--json'):
+			query = True
+		elif opt in ('-M', '--mirror'):
+			if arg.isdigit():
+				mirrorPort = int(arg)
+			else:
+				showUsage(True, arg)
+		elif opt in ('-r', '--relay'):
+			# Use a mirror (-M) on another Mac, the catalog points all downloads to the mirror.
+			SUCATALOG_URL = getMirrorCatalogURL(arg)
+			# Downloads fail over to the other mirrors (-F) and Apple.
+			MIRROR_URLS.insert(0, arg)
+		elif opt in ('-F', '--failover'):
+			# Mirrors to try (in this order) before Apple, or when the mirror (-r) fails.
+			MIRROR_URLS.append(arg)
+		elif opt in ('-b', '--buffer'):
+			# Download buffer size in KB (1024 by default).
+			if arg.isdigit() and int(arg) > 0:
+				DOWNLOAD_BUFFER_SIZE = int(arg) * 1024
+			else:
+				showUsage(True, arg)
+		elif opt in ('-T', '--telemetry'):
+			# Download telemetry, JSON lines (or Prometheus text format for <file>.prom).
+			TELEMETRY_FILE = arg
+		elif opt in ('-g', '--governor'):
+			# Bandwidth limit (optionally in a time window) and low CPU/disk priority.
+			if not startGovernor(arg):
+				showUsage(True, arg)
+		elif opt in ('-S', '--streams'):
+			# Limits for the number of download streams (one number for a fixed number of streams).
+			match = re.match(r'^(\d+)(?:-(\d+))?$', arg)
+
+			if match and 0 < int(match.group(1)) <= int(match.group(2) or match.group(1)):
+				STREAMS_MIN = int(match.group(1))
+				STREAMS_MAX = int(match.group(2) or match.group(1))
+				connectionPool.maxPerHost = max(HOST_CONNECTIONS, STREAMS_MAX)
+			else:
+				showUsage(True, arg)
+		elif opt in ('-p', '--program'):
+			if arg in seedProgramData or arg == 'all':
+				seedProgram = arg
+			else:
+				showUsage(True, arg)
 		else:
 			showUsage(True, arg)
 
-	key, distributionFile, targetVolume = getPackages(action, targetOSVersion, target, volume, unpackFolder, confirm, languageSelector)
+	if mirrorPort:
+		startMirror(mirrorPort)
+		sys.exit(0)
+	elif diff or query:
+		#
+		# Headless modes: no prompts, no screen clearing and nothing but JSON lines on stdout.
+		#
+		output = sys.stdout
+		sys.stdout = sys.stderr
+
+		if seedProgram == 'all':
+			seedPrograms = sorted(seedProgramData.keys())
+		else:
+			seedPrograms = [seedProgram or getSeedProgramName(volume or '/')]
+
+		if diff:
+			records = []
+
+			for catalog in seedPrograms:
+				records.extend(diffCatalog(SUCATALOG_URL + seedProgramData[catalog]))
+		else:
+			# The language picks the distribution file (build and beta check).
+			languageSelector = selectLanguage(getOSVersion())
+			records = queryProducts(seedPrograms, action, versionFilter, target if target != '*' else '', languageSelector, volume or '/')
+
+		for record in records:
+			output.write(json.dumps(record, sort_keys=True) + "\n")
+		sys.exit(0)
+
+	showCopyright()
+	#
+	# Not needed (and not computed) for -M and -d, -j gets its language selector above. On macOS
+	# 10.12 and later this loads Foundation.
+	#
+	macOSVersion = getOSVersion()
+	languageSelector = selectLanguage(macOSVersion)
+
+	if survey:
+		showSeedPrograms(languageSelector, volume or '/')
+		sys.exit(0)
+
+	key, distributionFile, distributionURL, targetVolume = getPackages(action, targetOSVersion, target, volume, unpackFolder, confirm, languageSelector)
 
  	if key == "":
  		print "Error: Aborting ..."
  	elif target == "*":
 		betaTag = ""
 			
-		if isBetaSeed(distributionFile):
+		if isBetaSeed(distributionFile, distributionURL):
 			betaTag = " Beta"
 			
 		applicationPath = os.path.join(targetVolume, "Applications/Install macOS High Sierra" + betaTag + ".app")
@@ -3,7 +3,7 @@
 #
 # Script (makeInstallSeedScript.py) to create a bash script that downloads the latest seed.
 #
-# Version 1.7 - Copyright (c) 2017 by Pike R. Alpha (PikeRAlpha@yahoo.com)
+# Version 2.1 - Copyright (c) 2017 by Pike R. Alpha (PikeRAlpha@yahoo.com)
 #
 # Updates:
 #          - comments added.
@@ -14,6 +14,10 @@
 #          - graceful exit with instructions to install pip/request module.
 #          - now using a generator object to get the buildID.
 #          - use urllib2 instead of requests (thanks to Per Olofsson aka MagerValp).
+#          - use the sucatalog cache (conditional GET) from installSeed.py.
+#          - use the streaming sucatalog reader from installSeed.py.
+#          - query the product index from installSeed.py (latest install product first).
+#          - use the (memoized) distribution file reader from installSeed.py to get the buildID.
 #
 
 import os
@@ -23,11 +27,12 @@ import fileinput
 import urllib2
 
 from Foundation import NSLocale
+from installSeed import SUCATALOG_URL, findProducts, getDistributionInfo
 
 #
 # Script version info.
 #
-scriptVersion=1.7
+scriptVersion=2.1
 
 #
 # GitHub branch to pull data from (master or Beta).
@@ -150,27 +155,14 @@ def downloadDistributionFile(product):
 
 			return distributionURL
 
-def getBuildID():
-	import xml.etree.ElementTree as ET
-	tree = ET.parse("/tmp/distribution.xml")
-	root = tree.getroot()
-	auxinfo = root.find('auxinfo')
-	
-	if auxinfo is not None:
-		auxinfo_iter = auxinfo.iter()
-
-		for element in auxinfo_iter:
-			if element.tag == 'key' and element.text == 'BUILD':
-				try:
-					return auxinfo_iter.next().text
-				except StopIteration:
-					pass
+def getBuildID(distributionURL):
+	return getDistributionInfo("/tmp/distribution.xml", distributionURL)['build'] or None
 
 def writeScript(key, url):
 	url_parts = url.split('/')
 	version = url_parts[5] + '/' + url_parts[6]
 	salt = url_parts[8]
-	buildID = getBuildID() or ""
+	buildID = getBuildID(url) or ""
 	scriptName = "installSeed-" + buildID + ".sh"
 	templateFileName = "installScriptTemplate.sh"
 	
@@ -216,35 +208,14 @@ print 'Seed Program Enrollment: ' + seedProgram
 # Get catalog path from seedProgramData.
 #
 catalog = seedProgramData.get(seedProgram, seedProgramData['PublicSeed'])
-catalogURL = "https://swscan.apple.com/content/catalogs/others/" + catalog
+catalogURL = SUCATALOG_URL + catalog
 
 #
-# Get the software update catalog (sucatalog).
+# Get the latest install product from the (SQLite) product index of the software update catalog (sucatalog).
 #
-catalogReq = urllib2.urlopen(catalogURL)
-catalogData = catalogReq.read()
+products = findProducts(catalogURL, 'install')
 
-#
-# Get root.
-#
-root = plistlib.readPlistFromString(catalogData)
-#
-# Get available products.
-#
-products = root['Products']
-
-#
-# Loop through the product available keys.
-#
-for key in products:
-	if 'ExtendedMetaInfo' in products[key]:
-		extendedMetaInfo = products[key]['ExtendedMetaInfo']
-		
-		if 'InstallAssistantPackageIdentifiers' in extendedMetaInfo:
-			IAPackageIDs = extendedMetaInfo['InstallAssistantPackageIdentifiers']
-			
-			if IAPackageIDs['InstallInfo'] == 'com.apple.plist.InstallInfo' and IAPackageIDs['OSInstall'] == 'com.apple.mpkg.OSInstall':
-				product = products[key]
-				distributionURL = downloadDistributionFile(product)
-				writeScript(key, distributionURL)
-				break
+if products:
+	key, product = products[0]
+	distributionURL = downloadDistributionFile(product)
+	writeScript(key, distributionURL)